@@ -0,0 +1,136 @@
+import os
+import re
+import sys
+import time
+import struct
+import logging
+import argparse
+import threading
+import socketserver
+
+# a stand-in for a Q process: speaks enough of the kdb+ IPC protocol for qpython to connect, answers every sync
+# message with a generic null and records what it received and how long the client kept it busy
+
+NULL_RESPONSE_BODY = b'\x65\x00'  # type 101 (generic null) with value 0
+FILE_LOAD_PATTERN = re.compile(r'0: `:(\S+?);')
+
+
+class MessageLog:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = []
+    
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+    
+    def take(self):
+        with self.lock:
+            records, self.records = self.records, []
+        return records
+
+
+def read_exactly(stream, n):
+    data = stream.read(n)
+    if data is None or len(data) < n:
+        raise EOFError()
+    return data
+
+
+def query_text(body, little_endian=True):
+    # the q expression of the message: either a char vector or the leading char vectors of a general list (function call, the
+    # managed connection sends its wrapper followed by the actual query)
+    fmt = '<i' if little_endian else '>i'
+    if body[0] != 0:
+        return char_vectors(body, 0, 1, fmt)
+    return char_vectors(body, 1 + 1 + 4, struct.unpack_from(fmt, body, 2)[0], fmt)  # type, attribute, length of the general list
+
+
+def char_vectors(body, offset, n_items, fmt):
+    texts = []
+    for _ in range(n_items):
+        if offset >= len(body) or body[offset] != 10:
+            break
+        length = struct.unpack_from(fmt, body, offset + 2)[0]
+        texts.append(body[offset + 6:offset + 6 + length].decode('latin-1'))
+        offset += 6 + length
+    return ' '.join(texts)
+
+
+def simulate_file_load(text):
+    # Q would read the extracted file from disk for 0: `:file, so we read it too to keep the disk cost realistic
+    match = FILE_LOAD_PATTERN.search(text)
+    if match is None or not os.path.isfile(match.group(1)):
+        return 0
+    n_bytes = 0
+    with open(match.group(1), 'rb') as f:
+        while True:
+            block = f.read(1 << 20)
+            if not block:
+                return n_bytes
+            n_bytes += len(block)
+
+
+class FakeQHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        handshake = b''
+        while not handshake.endswith(b'\x00'):
+            byte = self.rfile.read(1)
+            if not byte:
+                return
+            handshake += byte
+        self.wfile.write(b'\x03')
+        self.wfile.flush()
+        while True:
+            try:
+                header = read_exactly(self.rfile, 8)
+            except EOFError:
+                return
+            received = time.perf_counter()
+            little_endian = header[0] == 1
+            message_type = header[1]
+            size = struct.unpack('<I' if little_endian else '>I', header[4:8])[0]
+            body = read_exactly(self.rfile, size - 8)
+            text = query_text(body, little_endian)
+            bytes_read = simulate_file_load(text) if self.server.simulate_file_loads else 0
+            self.server.message_log.add({'received': received, 'message_type': message_type, 'size': size, 'query': text[:200],
+                                         'file_bytes_read': bytes_read, 'handled': time.perf_counter()})
+            if message_type == 1:
+                self.wfile.write(struct.pack('<BBBBI', 1, 2, 0, 0, 8 + len(NULL_RESPONSE_BODY)) + NULL_RESPONSE_BODY)
+                self.wfile.flush()
+            if text.strip() in ('exit 0', '\\\\'):
+                return
+
+
+class FakeQServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    
+    def __init__(self, port, simulate_file_loads=True):
+        super().__init__(('localhost', port), FakeQHandler)
+        self.message_log = MessageLog()
+        self.simulate_file_loads = simulate_file_loads
+
+
+def start_fake_q(port, simulate_file_loads=True):
+    server = FakeQServer(port, simulate_file_loads)
+    threading.Thread(target=server.serve_forever, name=f'fake-q-{port}', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a stand-in for a Q process that accepts IPC messages and logs them.')
+    parser.add_argument('--port', type=int, default=40000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    server = FakeQServer(args.port)
+    logging.info(f'Fake Q listening on port {args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        for record in server.message_log.take():
+            logging.info(record)
+
+
+if __name__ == '__main__':
+    main()
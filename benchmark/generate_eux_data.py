@@ -0,0 +1,115 @@
+import os
+import sys
+import gzip
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from feeds import FEEDS  # noqa: E402
+
+# writes gzipped, | separated EUX files in the layouts declared in feeds.py (YYYYMMDD_<instrument id><file_suffix>, one file per
+# instrument and day) so the loaders can be benchmarked without access to the real data; a small share of the rows fails the keep
+# filter of each feed, like in the real files
+
+SESSION_START_SEC = 8 * 3600
+SESSION_END_SEC = 22 * 3600
+FILTERED_SHARE = 0.005  # rows with a zero price/quantity that the loaders drop
+FIRST_INSTRUMENT_ID = 100000
+
+
+def business_days(start, n_days):
+    return [x.strftime('%Y%m%d') for x in pd.bdate_range(start=start, periods=n_days)]
+
+
+def instrument_isin(instrument_id):
+    return f'DE000C{instrument_id:06d}'
+
+
+def hhmmss(seconds):
+    return 10000 * (seconds // 3600) + 100 * ((seconds // 60) % 60) + seconds % 60
+
+
+def random_walk(rng, n_rows, start):
+    return np.round(np.maximum(start + np.cumsum(rng.normal(0, 0.02, n_rows)), 0.01), 2)
+
+
+def feed_frame(schema, rng, isin, date_string, n_rows):
+    # a column for every entry of the schema, in file order, with values that look like the real thing
+    seconds = np.sort(rng.integers(SESSION_START_SEC, SESSION_END_SEC, n_rows))
+    sub_seconds = rng.integers(0, 1000000, n_rows)  # microseconds, the loaders multiply by 1000
+    price = random_walk(rng, n_rows, rng.uniform(20, 500))
+    filtered = rng.random(n_rows) < FILTERED_SHARE
+    columns = {}
+    for name, q_type in schema.columns:
+        if name == 'ISIN':
+            values = np.full(n_rows, isin)
+        elif name == 'Date':
+            values = np.full(n_rows, date_string)
+        elif name == 'TimeSec':
+            values = hhmmss(seconds)
+        elif name in ('TimeMM', 'MarketTimeMM'):
+            values = sub_seconds
+        elif name == 'MarketTime':
+            values = hhmmss(seconds)
+        elif name in ('Price', 'Last_Px', 'Ref_Px') or name.startswith('Bid_Px') or name.startswith('Ask_Px'):
+            level = int(name[-1]) + 1 if name.endswith(tuple('0123456789')) else 0
+            tick = -0.01 * level if name.startswith('Bid') else 0.01 * level
+            values = np.round(price + tick, 2)
+        elif name == 'Side':
+            values = rng.integers(1, 3, n_rows)
+        elif q_type == 'S':
+            values = np.full(n_rows, 'EUR')
+        elif q_type == 'I':
+            values = rng.integers(1, 500, n_rows)
+        else:
+            values = np.round(rng.uniform(1, 1000, n_rows), 2)
+        columns[name] = values
+    for column, _, _ in schema.keep:
+        columns[column] = np.where(filtered, 0, columns[column])
+    frame = pd.DataFrame(columns)
+    if 'Volume' in frame and 'Qty' in frame:
+        frame['Volume'] = frame['Qty'] * np.maximum(np.round(frame['Price']).astype(np.int64), 1)
+    return frame
+
+
+def write_feed_file(frame, full_output_filename):
+    with gzip.open(full_output_filename, 'wt', compresslevel=6, newline='') as f_out:
+        frame.to_csv(f_out, sep='|', index=False, lineterminator='\n')
+
+
+def generate(out_dir, feeds, start, n_days, n_instruments, rows_per_day, seed=1):
+    # rows_per_day is per feed, split evenly over the instruments; returns the list of files written
+    rng = np.random.default_rng(seed)
+    written = []
+    for feed in feeds:
+        schema = FEEDS[feed]
+        data_path = os.path.join(out_dir, schema.venue).replace("\\", "/")
+        os.makedirs(data_path, exist_ok=True)
+        for date_string in business_days(start, n_days):
+            for instrument_id in range(FIRST_INSTRUMENT_ID, FIRST_INSTRUMENT_ID + n_instruments):
+                full_output_filename = os.path.join(data_path, f'{date_string}_{instrument_id}{schema.file_suffix}').replace("\\", "/")
+                frame = feed_frame(schema, rng, instrument_isin(instrument_id), date_string, max(rows_per_day // n_instruments, 1))
+                write_feed_file(frame, full_output_filename)
+                written.append(full_output_filename)
+        logging.info(f'Wrote {n_days * n_instruments} {feed} files to {data_path}')
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic EUX source files in the layouts of feeds.py.')
+    parser.add_argument('--out', required=True, help='source root to write to, the files go into its venue sub directories')
+    parser.add_argument('--feeds', nargs='+', default=list(FEEDS), choices=list(FEEDS))
+    parser.add_argument('--start', default='2017-05-02', help='first business day')
+    parser.add_argument('--days', type=int, default=2)
+    parser.add_argument('--instruments', type=int, default=2)
+    parser.add_argument('--rows-per-day', type=int, default=1000000, help='rows per feed and day, split over the instruments')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    generate(args.out, args.feeds, args.start, args.days, args.instruments, args.rows_per_day, args.seed)
+
+
+if __name__ == '__main__':
+    main()
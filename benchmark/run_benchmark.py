@@ -0,0 +1,149 @@
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import setup_kdb  # noqa: E402
+import py_engine  # noqa: E402
+from feeds import FEEDS  # noqa: E402
+from metrics import STAGES, MetricsRecorder  # noqa: E402
+from qconn import ManagedQConnection  # noqa: E402
+from fake_q import start_fake_q  # noqa: E402
+from generate_eux_data import generate  # noqa: E402
+
+# runs every loader mode end to end over the same (synthetic) source files against a local Q stand-in and reports rows/s, MB/s and the
+# time spent per stage (see metrics.py); point --port at a real Q process (with --no-fake-q) to include the cost of Q itself
+
+MODES = {
+    'extract': {'engine': 'q', 'stream': False, 'prefetch_files': 0},
+    'extract-prefetch': {'engine': 'q', 'stream': False, 'prefetch_files': setup_kdb.PREFETCH_FILES},
+    'stream': {'engine': 'q', 'stream': True, 'prefetch_files': 0},
+    'stream-prefetch': {'engine': 'q', 'stream': True, 'prefetch_files': setup_kdb.PREFETCH_FILES},
+    'python': {'engine': 'python'},
+    'python-parquet': {'engine': 'python', 'sink': 'parquet'},
+    'python-arrow': {'engine': 'python', 'sink': 'arrow'},
+}
+ALL_DAYS_PATTERN = '[0-9]{6}'  # month pattern matching every file of a feed
+MB = 1 << 20
+
+
+def source_volume(data_root, feeds):
+    # (files, data rows, compressed bytes, uncompressed bytes) of the files the loaders will read
+    n_files, n_rows, n_compressed, n_uncompressed = 0, 0, 0, 0
+    for feed in feeds:
+        data_path = os.path.join(data_root, FEEDS[feed].venue).replace("\\", "/")
+        for zipped_filename in setup_kdb.find_pattern_files(setup_kdb.month_file_pattern(ALL_DAYS_PATTERN, FEEDS[feed].file_suffix), data_path):
+            full_input_filename = os.path.join(data_path, zipped_filename).replace("\\", "/")
+            n_files += 1
+            n_compressed += os.path.getsize(full_input_filename)
+            with gzip.open(full_input_filename, 'rb') as f_in:
+                for block in iter(lambda: f_in.read(1 << 20), b''):
+                    n_uncompressed += len(block)
+                    n_rows += block.count(b'\n')
+            n_rows -= 1  # header
+    return n_files, n_rows, n_compressed, n_uncompressed
+
+
+def run_mode(mode, q, data_root, feeds, work_dir, metrics_file=None):
+    settings = MODES[mode]
+    kdb_root = os.path.join(work_dir, f'kdb_{mode}').replace("\\", "/")
+    temp_dir = os.path.join(work_dir, f'extract_{mode}').replace("\\", "/")
+    os.makedirs(temp_dir, exist_ok=True)
+    metrics = MetricsRecorder(metrics_file)
+    sink = None
+    if settings.get('sink') is not None:
+        from parquet_sink import ColumnarSink
+        sink = ColumnarSink(os.path.join(work_dir, f'columnar_{mode}').replace("\\", "/"), settings['sink'])
+    start = time.perf_counter()
+    for feed in feeds:
+        schema = FEEDS[feed]
+        data_path = os.path.join(data_root, schema.venue).replace("\\", "/")
+        kdb_dir = os.path.join(kdb_root, schema.hdb).replace("\\", "/")
+        pattern = setup_kdb.month_file_pattern(ALL_DAYS_PATTERN, schema.file_suffix)
+        if settings['engine'] == 'python':
+            py_engine.process_pattern_fileBatch_py(pattern, feed, q, data_path=data_path, kdb_dir=kdb_dir, metrics=metrics, sink=sink)
+        else:
+            setup_kdb.process_pattern_fileBatch(pattern, feed, q, data_path=data_path, temp_dir=temp_dir, kdb_dir=kdb_dir, stream=settings['stream'],
+                                                prefetch_files=settings['prefetch_files'], metrics=metrics)
+    wall_seconds = time.perf_counter() - start
+    metrics.close()
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    return wall_seconds, metrics.summary()
+
+
+def report(mode, wall_seconds, summary, volume, messages):
+    # rows and bytes come from the sources, the Q stand-in cannot count what it did not parse
+    n_files, n_rows, n_compressed, n_uncompressed = volume
+    result = {'mode': mode, 'files': n_files, 'rows': n_rows, 'wall_s': round(wall_seconds, 3),
+              'rows_per_s': round(n_rows / wall_seconds), 'gz_mb_per_s': round(n_compressed / MB / wall_seconds, 2),
+              'csv_mb_per_s': round(n_uncompressed / MB / wall_seconds, 2), 'ipc_messages': len(messages),
+              'ipc_mb': round(sum(x['size'] for x in messages) / MB, 2)}
+    for stage in STAGES:
+        result[f'{stage}_s'] = summary['stages_s'].get(stage, 0.0)
+    return result
+
+
+def print_results(results):
+    columns = ['mode', 'rows', 'wall_s', 'rows_per_s', 'gz_mb_per_s', 'csv_mb_per_s', 'ipc_mb'] + [f'{stage}_s' for stage in STAGES]
+    widths = [max(len(column), *(len(str(x[column])) for x in results)) for column in columns]
+    print('  '.join(column.rjust(width) for column, width in zip(columns, widths)))
+    for result in results:
+        print('  '.join(str(result[column]).rjust(width) for column, width in zip(columns, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the loader modes end to end on synthetic EUX data.')
+    parser.add_argument('--data', help='source root with the venue sub directories, generated into the work directory if not given')
+    parser.add_argument('--work', help='directory for the generated data, extracted files and HDBs (a temporary one by default)')
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=list(MODES))
+    parser.add_argument('--feeds', nargs='+', default=list(FEEDS), choices=list(FEEDS))
+    parser.add_argument('--days', type=int, default=2)
+    parser.add_argument('--instruments', type=int, default=2)
+    parser.add_argument('--rows-per-day', type=int, default=200000)
+    parser.add_argument('--port', type=int, default=40100)
+    parser.add_argument('--no-fake-q', action='store_true', help='do not start the Q stand-in, a Q process is listening on --port already')
+    parser.add_argument('--results', help='append the results as json lines to this file')
+    parser.add_argument('--metrics', help='append the per file metrics of every mode as json lines to this file')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, stream=sys.stdout)
+    
+    work_dir = args.work if args.work is not None else tempfile.mkdtemp(prefix='beetroot_benchmark_')
+    data_root = args.data
+    if data_root is None:
+        data_root = os.path.join(work_dir, 'src').replace("\\", "/")
+        generate(data_root, args.feeds, '2017-05-02', args.days, args.instruments, args.rows_per_day)
+    volume = source_volume(data_root, args.feeds)
+    
+    fake_q = None if args.no_fake_q else start_fake_q(args.port)
+    q = ManagedQConnection(host='localhost', port=args.port)
+    q.open()
+    results = []
+    try:
+        for mode in args.modes:
+            if fake_q is not None:
+                fake_q.message_log.take()
+            wall_seconds, summary = run_mode(mode, q, data_root, args.feeds, work_dir, args.metrics)
+            messages = fake_q.message_log.take() if fake_q is not None else []
+            results.append(report(mode, wall_seconds, summary, volume, messages))
+    finally:
+        q.close()
+        if fake_q is not None:
+            fake_q.shutdown()
+        if args.work is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    
+    print_results(results)
+    if args.results is not None:
+        with open(args.results, 'a') as f_out:
+            for result in results:
+                f_out.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+from collections import namedtuple
+
+# every feed we load is declared once here, the Q pipeline in setup_kdb.py and the pandas one in py_engine.py are both driven by it
+#   name          : feed name used on the command line and in the logs
+#   venue         : sub directory of the source root holding the files (EUX, ETF, MTA ...)
+#   file_suffix   : files are named YYYYMMDD_<instrument id><file_suffix>
+#   table         : Q table name, also the name of the splayed table inside each date partition
+#   hdb           : sub directory of the KDB root holding the partitioned database
+#   columns       : (name, q type) in file order, the types make up the 0: type string; Q and pandas take the names from the header line
+#                   of each file, the names here document the layout (only the ones used below have to match)
+#   time_columns  : (date, HHMMSS seconds, sub second) columns the time column is derived from
+#   keep          : (column, q comparison, value) rows have to satisfy to be loaded
+#   drop          : columns removed once sym and time are derived
+#   first_columns : column order at the front of the table (xcols)
+#   partition_by  : the .Q.dpft field, the partition is sorted on it and gets the p# attribute
+#   chunk_rows    : None loads a whole file into Q before writing it, n appends it to the date partition on disk in blocks of n rows
+#                   (Q memory stays bounded whatever the size of the file) and puts p# back on the partition once the file is in (the
+#                   blocks of a file are one sym); the partition is sorted on disk once, after the last file of its date
+#   dedup_columns : columns identifying a row for the optional deduplication of whole day writes, None compares whole rows
+FeedSchema = namedtuple('FeedSchema', ['name', 'venue', 'file_suffix', 'table', 'hdb', 'columns', 'time_columns', 'keep', 'drop',
+                                       'first_columns', 'partition_by', 'chunk_rows', 'dedup_columns'], defaults=[None, None])
+
+SYM_SOURCE_COLUMN = 'ISIN'  # sym is the ISIN of the instrument in all our feeds
+Q_SUM_STATS = '{(sum x[;0]; min x[;1]; max x[;2]; sum x[;3])}'  # q_table_stats of the blocks of a partition => those of all of them
+
+# Q's encoding of the values we move between Q and numpy/arrow ourselves
+Q_INT_NULL = -2 ** 31  # 0Ni
+Q_LONG_NULL = -2 ** 63  # 0Nj, 0Np
+Q_EPOCH_NANOS = 946684800 * 1000000000  # 2000.01.01 in nanoseconds since 1970.01.01
+Q_EPOCH_DAYS = 10957  # 2000.01.01 in days since 1970.01.01
+
+BOOK_LEVEL_COLUMNS = [(f'{side}_{field}_Lev_{level}', 'F') for level in range(4) for side in ('Bid', 'Ask') for field in ('Px', 'Qty')]
+
+FEEDS = {
+    'trades': FeedSchema(name='trades', venue='EUX', file_suffix='_MKtrade.csv.gz', table='trades', hdb='trades',
+                         columns=[('ISIN', 'S'), ('Date', 'D'), ('TimeSec', 'I'), ('TimeMM', 'I'), ('MarketTime', 'I'), ('Qty', 'I'),
+                                  ('Price', 'F'), ('Volume', 'I')],
+                         time_columns=('Date', 'TimeSec', 'TimeMM'), keep=[('Price', '<>', 0)],
+                         drop=['ISIN', 'TimeMM', 'Date', 'TimeSec', 'MarketTime'], first_columns=['sym', 'time', 'Price', 'Qty', 'Volume'],
+                         partition_by='sym', dedup_columns=['sym', 'time', 'Price', 'Qty']),
+    'orders': FeedSchema(name='orders', venue='EUX', file_suffix='_Order.csv.gz', table='orders', hdb='orders',
+                         columns=[('ISIN', 'S'), ('Date', 'D'), ('TimeSec', 'I'), ('TimeMM', 'I'), ('MarketTime', 'I'), ('Price', 'F'),
+                                  ('Qty', 'I'), ('Value', 'F'), ('MarketTimeMM', 'I'), ('OrderType', 'I'), ('Side', 'I'), ('Currency', 'S'),
+                                  ('Bid_Px', 'F'), ('Ask_Px', 'F'), ('Ref_Px', 'F')],
+                         time_columns=('Date', 'TimeSec', 'TimeMM'), keep=[('Qty', '<>', 0)],
+                         drop=['ISIN', 'TimeMM', 'Date', 'TimeSec', 'MarketTime', 'MarketTimeMM'], first_columns=['sym', 'time'],
+                         partition_by='sym', dedup_columns=['sym', 'time', 'Price', 'Qty', 'Side']),
+    'books': FeedSchema(name='books', venue='EUX', file_suffix='_Book.csv.gz', table='books', hdb='books',
+                        columns=[('ISIN', 'S'), ('Date', 'D'), ('TimeSec', 'I'), ('TimeMM', 'I'), ('MarketTime', 'F')] + BOOK_LEVEL_COLUMNS +
+                                [('Last_Px', 'F'), ('Last_Qty', 'F'), ('Turnover', 'F')],
+                        time_columns=('Date', 'TimeSec', 'TimeMM'), keep=[('Bid_Px_Lev_0', '>', 0)],
+                        drop=['ISIN', 'TimeMM', 'Date', 'TimeSec', 'MarketTime'], first_columns=['sym', 'time'],
+                        partition_by='sym', chunk_rows=500000),
+}
+# the ETF and MTA venues only need their own entries, e.g.
+# FEEDS['mta_trades'] = FEEDS['trades']._replace(name='mta_trades', venue='MTA', hdb='mta_trades')
+
+
+def type_string(schema):
+    return ''.join(q_type for _, q_type in schema.columns)
+
+
+def q_time_expression(schema):
+    date_column, seconds_column, sub_second_column = schema.time_columns
+    return f'(1000*{sub_second_column}) + {date_column} + `second$(60*60*{seconds_column} div 10000) + (60 * ({seconds_column} mod 10000) div 100) + ' \
+           f'({seconds_column} mod 100)'
+
+
+def q_transform(schema, source):
+    # one fused Q expression taking the raw table `source` to the table we write: filter first so the derived columns are only built
+    # for the rows we keep, then derive sym/time, drop the raw columns and reorder
+    where = ','.join(f'{column}{comparison}{value}' for column, comparison, value in schema.keep)
+    return f'{"`" + "`".join(schema.first_columns)} xcols delete {",".join(schema.drop)} from ' \
+           f'(update sym:{SYM_SOURCE_COLUMN}, time:{q_time_expression(schema)} from (select from ({source}) where {where}))'
+
+
+def q_table_stats(table):
+    # Q expression for what validation compares between the data we write and the partition on disk: (rows; min time; max time;
+    # column => checksum) with times as nanoseconds; the checksums are sums (numbers as longs, floats to 6 decimals, symbols weighted by
+    # their characters) so they do not depend on the row order (.Q.dpft sorts) and add up over the files and blocks of a partition
+    column_checksum = '{x:$[type[x] within 20 76h; value x; x]; $[11h=type x; [s:distinct x; sum ({sum (1+til count x)*"j"$x} each string s) s?x]; ' \
+                      'type[x] in 8 9h; sum "j"$1e6*x; sum "j"$x]}'
+    return f'{{[t] (count t; "j"$min t`time; "j"$max t`time; {column_checksum} each flip 0!t)}}[{table}]'
+
+
+def q_parse(schema, source):
+    # Q expression parsing `source` (a file handle or a list of csv lines including the header) with the feed types
+    return f'("{type_string(schema)}";enlist "|") 0: {source}'
+
+
+def q_csv_lines(header, text):
+    # Q expression: the list of csv lines q_parse takes, from the header line and a block of whole lines (one char vector, as streamed),
+    # split in Q; \r and blank lines are dropped, the last line needs no \n
+    return f'(enlist {header}), {{x where 0<count each x}}["\\n" vs {text} where not {text}="\\r"]'
@@ -0,0 +1,100 @@
+import os
+import re
+import json
+import bisect
+import logging
+import threading
+from collections import namedtuple
+
+# one listing per source directory instead of one per month pattern and feed: each directory is scanned once with os.scandir (on Windows
+# shares the sizes and mtimes come with the listing), the file names are parsed into date / instrument id / file type and kept sorted so
+# the feed/month batches are answered from memory; persisted, a directory is only scanned again once its mtime changed (a file was
+# added, removed or renamed; files rewritten in place are the manifest's business)
+
+# YYYYMMDD_<instrument id><file suffix>, e.g. 20170502_4711_MKtrade.csv.gz; the suffix is taken from the right, instrument ids can hold
+# underscores (20170502_FDAX_1706_Book.csv.gz)
+SOURCE_FILE_PATTERN = re.compile(r'^(\d{8})_(.+?)(_([^_.]+)\..+)$')
+
+SourceFile = namedtuple('SourceFile', ['date', 'instrument', 'suffix', 'file_type', 'name', 'size', 'mtime'])
+
+
+def scan_directory(data_path):
+    # (names of all files, SourceFile of the ones named like source files) in one pass over the directory
+    names, source_files = [], []
+    with os.scandir(data_path) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            names.append(entry.name)
+            match = SOURCE_FILE_PATTERN.match(entry.name)
+            if match is not None:
+                stat = entry.stat()
+                source_files.append(SourceFile(match.group(1), match.group(2), match.group(3), match.group(4), entry.name, stat.st_size,
+                                               stat.st_mtime))
+    names.sort()
+    source_files.sort()
+    return names, source_files
+
+
+class DirectoryIndex:
+    def __init__(self, mtime, names, source_files):
+        self.mtime = mtime
+        self.names = names
+        self.source_files = source_files
+        self.by_suffix = {}  # file suffix => SourceFiles sorted by date, instrument
+        for source_file in source_files:
+            self.by_suffix.setdefault(source_file.suffix, []).append(source_file)
+
+
+class SourceIndex:
+    def __init__(self, cache_path=None):
+        # cache_path: json file the listings are kept in between runs, None keeps them for this run only
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+        self.directories = {}  # normalised data path => DirectoryIndex
+        self.checked = set()  # directories whose listing is known to be current in this run
+        self.changed = False
+        if cache_path is not None and os.path.isfile(cache_path):
+            with open(cache_path) as f_in:
+                for data_path, cached in json.load(f_in).items():
+                    self.directories[data_path] = DirectoryIndex(cached['mtime'], cached['names'], [SourceFile(*x) for x in cached['files']])
+    
+    def directory(self, data_path):
+        data_path = os.path.normpath(data_path).replace("\\", "/")
+        with self.lock:
+            if data_path not in self.checked:
+                mtime = os.stat(data_path).st_mtime
+                cached = self.directories.get(data_path)
+                if cached is None or cached.mtime != mtime:
+                    logging.info(f'Scanning {data_path}')
+                    self.directories[data_path] = DirectoryIndex(mtime, *scan_directory(data_path))
+                    self.changed = True
+                    logging.info(f'Indexed {len(self.directories[data_path].source_files)} source files in {data_path}')
+                self.checked.add(data_path)
+            return self.directories[data_path]
+    
+    def match(self, toMatchPattern, data_path):
+        # the file names in data_path matching the regex, sorted, like a filtered os.listdir
+        match_pattern = re.compile(toMatchPattern)
+        return [x for x in self.directory(data_path).names if match_pattern.match(x) is not None]
+    
+    def files(self, data_path, suffix, start_date=None, end_date=None, instruments=None):
+        # SourceFiles with the file suffix and start_date <= date <= end_date (YYYYMMDD strings, inclusive), sorted by date and instrument
+        source_files = self.directory(data_path).by_suffix.get(suffix, [])
+        lo = 0 if start_date is None else bisect.bisect_left(source_files, (start_date,))
+        hi = len(source_files) if end_date is None else bisect.bisect_left(source_files, (end_date + '\x7f',))
+        if instruments is None:
+            return source_files[lo:hi]
+        return [x for x in source_files[lo:hi] if x.instrument in instruments]
+    
+    def save(self):
+        if self.cache_path is None or not self.changed:
+            return
+        with self.lock:
+            cached = {data_path: {'mtime': x.mtime, 'names': x.names, 'files': [list(y) for y in x.source_files]}
+                      for data_path, x in self.directories.items()}
+            temp_path = self.cache_path + '.tmp'
+            with open(temp_path, 'w') as f_out:
+                json.dump(cached, f_out)
+            os.replace(temp_path, self.cache_path)
+            self.changed = False
@@ -0,0 +1,146 @@
+import os
+import json
+import shutil
+import sqlite3
+import hashlib
+import logging
+import threading
+from datetime import datetime
+
+# a persisted record of every source file we ingested, so a rerun only touches what is new or changed and a crash only costs the
+# file(s) that were in flight
+
+NEW = 'new'  # never seen, or seen but nothing of it was written (failed before the partition write)
+COMPLETE = 'complete'  # loaded and unchanged since
+CHANGED = 'changed'  # loaded, but the source changed since => its partition has to be rewritten
+INCOMPLETE = 'incomplete'  # started but never finished (crash/failure) => its partition may hold part of it
+
+CHECKSUM_BLOCK_SIZE = 1 << 20
+
+
+def file_checksum(path):
+    checksum = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHECKSUM_BLOCK_SIZE), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def wrap_long(value):
+    # Q longs wrap around on overflow, so sums of checksums have to as well to compare with what Q computes
+    return (value + (1 << 63)) % (1 << 64) - (1 << 63)
+
+
+def table_stats(result):
+    # the result of feeds.q_table_stats as {'rows', 'min_time', 'max_time', 'checksums'}, None if Q gave us nothing (or not a Q process)
+    if not isinstance(result, list) or len(result) != 4:
+        return None
+    rows, min_time, max_time, checksums = result
+    return {'rows': int(rows), 'min_time': int(min_time), 'max_time': int(max_time),
+            'checksums': {(x.decode() if isinstance(x, bytes) else str(x)): int(y) for x, y in zip(checksums.keys, checksums.values)}}
+
+
+def reset_partition(kdb_dir, date_string, table_name):
+    # removes the splayed table of one date partition so it can be written again from scratch
+    table_dir = os.path.join(kdb_dir, date_string, table_name).replace("\\", "/")
+    if os.path.isdir(table_dir):
+        shutil.rmtree(table_dir)
+        logging.info(f'Removed partition {table_dir}')
+
+
+class IngestManifest:
+    def __init__(self, path, use_checksum=False):
+        # use_checksum: a changed size/mtime is only believed if the content checksum changed as well (e.g. files re-copied to the share)
+        self.path = path
+        self.use_checksum = use_checksum
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS ingested_files (source_path TEXT, kdb_dir TEXT, feed TEXT, date TEXT, size INTEGER, '
+                        'mtime REAL, checksum TEXT, row_count INTEGER, status TEXT, updated TEXT, min_time INTEGER, max_time INTEGER, '
+                        'column_checksums TEXT, PRIMARY KEY (source_path, kdb_dir))')
+        self.db.commit()
+    
+    def close(self):
+        with self.lock:
+            self.db.close()
+    
+    def file_state(self, source_path, kdb_dir):
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime, checksum, status FROM ingested_files WHERE source_path=? AND kdb_dir=?',
+                                  (source_path, kdb_dir)).fetchone()
+        if row is None:
+            return NEW
+        size, mtime, checksum, status = row
+        if status == 'failed':
+            return NEW
+        if status != COMPLETE:
+            return INCOMPLETE
+        stat = os.stat(source_path)
+        if stat.st_size == size and stat.st_mtime == mtime:
+            return COMPLETE
+        if self.use_checksum and checksum is not None and stat.st_size == size and file_checksum(source_path) == checksum:
+            with self.lock:
+                self.db.execute('UPDATE ingested_files SET mtime=? WHERE source_path=? AND kdb_dir=?', (stat.st_mtime, source_path, kdb_dir))
+                self.db.commit()
+            return COMPLETE
+        return CHANGED
+    
+    def _record(self, source_path, kdb_dir, feed, date_string, status, row_count=None, stats=None):
+        stat = os.stat(source_path)
+        checksum = file_checksum(source_path) if self.use_checksum and status == COMPLETE else None
+        min_time, max_time, column_checksums = (None, None, None) if stats is None else \
+            (stats['min_time'], stats['max_time'], json.dumps(stats['checksums']))
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO ingested_files (source_path, kdb_dir, feed, date, size, mtime, checksum, row_count, status, '
+                            'updated, min_time, max_time, column_checksums) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                            (source_path, kdb_dir, feed, date_string, stat.st_size, stat.st_mtime, checksum, row_count, status,
+                             datetime.now().isoformat(), min_time, max_time, column_checksums))
+            self.db.commit()
+    
+    def mark_started(self, source_path, kdb_dir, feed, date_string):
+        self._record(source_path, kdb_dir, feed, date_string, 'started')
+    
+    def mark_complete(self, source_path, kdb_dir, feed, date_string, row_count, stats=None):
+        # stats: table_stats of what was written for the file, what validate_hdb.py expects to find in the partition
+        self._record(source_path, kdb_dir, feed, date_string, COMPLETE, row_count, stats)
+    
+    def mark_failed(self, source_path, kdb_dir, feed, date_string):
+        # only for files that failed before anything was written, an exception half way leaves the file 'started'
+        self._record(source_path, kdb_dir, feed, date_string, 'failed')
+    
+    def forget_partition(self, kdb_dir, date_string):
+        # after a partition was reset none of the files that went into it count as loaded anymore
+        with self.lock:
+            self.db.execute('DELETE FROM ingested_files WHERE kdb_dir=? AND date=?', (kdb_dir, date_string))
+            self.db.commit()
+    
+    def partition_expectations(self, kdb_dir, start_date=None, end_date=None, updated_since=None):
+        # date => table_stats summed over the complete files of the partition (checksums None if a file was loaded without them), for the
+        # dates between start_date and end_date (YYYY.MM.DD) and, with updated_since (isoformat), only those with a file loaded since then
+        query = 'SELECT date, row_count, min_time, max_time, column_checksums, updated FROM ingested_files WHERE kdb_dir=? AND status=?'
+        with self.lock:
+            rows = self.db.execute(query, (kdb_dir, COMPLETE)).fetchall()
+        expectations, touched = {}, set()
+        for date_string, row_count, min_time, max_time, column_checksums, updated in rows:
+            if (start_date is not None and date_string < start_date) or (end_date is not None and date_string > end_date):
+                continue
+            if updated_since is not None and updated >= updated_since:
+                touched.add(date_string)
+            expected = expectations.setdefault(date_string, {'rows': 0, 'min_time': None, 'max_time': None, 'checksums': {}, 'files': 0})
+            expected['files'] += 1
+            expected['rows'] += row_count or 0
+            if min_time is not None:
+                expected['min_time'] = min_time if expected['min_time'] is None else min(expected['min_time'], min_time)
+                expected['max_time'] = max_time if expected['max_time'] is None else max(expected['max_time'], max_time)
+            if column_checksums is None or expected['checksums'] is None:
+                expected['checksums'] = None
+                continue
+            for column, checksum in json.loads(column_checksums).items():
+                expected['checksums'][column] = wrap_long(expected['checksums'].get(column, 0) + checksum)
+        if updated_since is not None:
+            expectations = {x: y for x, y in expectations.items() if x in touched}
+        return expectations
+    
+    def summary(self):
+        with self.lock:
+            return self.db.execute('SELECT feed, status, COUNT(*), SUM(row_count) FROM ingested_files GROUP BY feed, status').fetchall()
@@ -0,0 +1,157 @@
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+# per file timings, sizes and row counts of the ingestion, written as one json line per file so a slow night can be pinned on the disk,
+# gzip or Q; the stages are
+#   copy     : copying the .gz to the extract directory
+#   extract  : gunzip to disk, or decompressing and splitting into line chunks when streaming
+#   parse    : Q parse and transform (Q engine) or pandas parse and transform (python engine)
+#   push     : sending ready columns to Q (python engine)
+#   write    : .Q.dpft of the partition (or sorting a chunked one); blocks are sent async, so the wait for Q to finish parsing them ends
+#              up here as well
+#   export   : writing the parquet/arrow copy (python engine with a PARQUET_ROOT_DIR)
+#   cleanup  : deleting the copies
+# with prefetching the stages of different files overlap, so their sum can be more than the wall time; the wall time of a file runs from
+# the moment the loader picks it up (start), what a prefetch thread did for it before that only shows in its stages
+
+STAGES = ['copy', 'extract', 'parse', 'push', 'write', 'export', 'cleanup']
+MB = 1 << 20
+
+
+class FileMetrics:
+    def __init__(self, feed, source_path, mode=None):
+        self.feed = feed
+        self.source_path = source_path
+        self.mode = mode
+        self.date = None
+        self.status = None
+        self.started = time.time()
+        self.finished = None
+        self.stages = {}
+        self.bytes_in = os.path.getsize(source_path) if os.path.isfile(source_path) else None  # compressed source
+        self.csv_bytes = 0  # uncompressed csv that went through the parser
+        self.bytes_out = None  # size of the splayed table of the partition after the write
+        self.rows_in = 0  # before the keep filter
+        self.rows_out = None  # written to the partition
+        self.q_memory = {}  # .Q.w[] after the write
+        self.retries = 0  # times the file was loaded again after the connection to Q dropped
+    
+    def add_stage(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+    
+    @contextmanager
+    def stage(self, stage):
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add_stage(stage, time.perf_counter() - start)
+    
+    def timed_items(self, stage, items):
+        # for generators the work happens while the caller asks for the next item, so that is what we time
+        items = iter(items)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                self.add_stage(stage, time.perf_counter() - start)
+            yield item
+    
+    def start(self):
+        # the FileMetrics of prefetched files exist from the start of the batch, the loader calls this once it gets to the file
+        self.started = time.time()
+    
+    def restart(self):
+        # the counts start over when a file is loaded again, the stage times keep adding up
+        self.retries += 1
+        self.csv_bytes = 0
+        self.rows_in = 0
+    
+    def finish(self, status):
+        self.status = status
+        self.finished = time.time()
+    
+    def as_dict(self):
+        return {'feed': self.feed, 'source_path': self.source_path, 'mode': self.mode, 'date': self.date, 'status': self.status,
+                'started': datetime.fromtimestamp(self.started).isoformat(),
+                'wall_s': None if self.finished is None else round(self.finished - self.started, 6),
+                'stages_s': {stage: round(seconds, 6) for stage, seconds in self.stages.items()}, 'bytes_in': self.bytes_in,
+                'csv_bytes': self.csv_bytes, 'bytes_out': self.bytes_out, 'rows_in': self.rows_in, 'rows_out': self.rows_out,
+                'retries': self.retries, 'q_memory': self.q_memory}
+
+
+def q_memory(q):
+    # .Q.w[] of the Q process as a dict (used, heap, peak, wmax, mmap, mphy, syms, symw)
+    memory = q('.Q.w[]')
+    if memory is None or not hasattr(memory, 'values'):
+        return {}
+    return {(x.decode() if isinstance(x, bytes) else str(x)): int(y) for x, y in zip(memory.keys, memory.values)}
+
+
+def partition_size(kdb_dir, date_string, table_name):
+    table_dir = os.path.join(kdb_dir, date_string, table_name).replace("\\", "/")
+    if not os.path.isdir(table_dir):
+        return None
+    return sum(x.stat().st_size for x in os.scandir(table_dir) if x.is_file())
+
+
+class MetricsRecorder:
+    def __init__(self, path=None):
+        # path: json lines file the per file records are appended to, None only keeps the totals for the summary
+        self.path = path
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.n_files = {}
+        self.totals = {'bytes_in': 0, 'csv_bytes': 0, 'rows_in': 0, 'rows_out': 0}
+        self.stage_totals = {}
+        self.peak_q_memory = 0
+        self.out = None
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.out = open(path, 'a')
+    
+    def record(self, file_metrics):
+        record = file_metrics.as_dict()
+        with self.lock:
+            self.n_files[file_metrics.status] = self.n_files.get(file_metrics.status, 0) + 1
+            for field in self.totals:
+                self.totals[field] += record[field] or 0
+            for stage, seconds in file_metrics.stages.items():
+                self.stage_totals[stage] = self.stage_totals.get(stage, 0.0) + seconds
+            self.peak_q_memory = max(self.peak_q_memory, file_metrics.q_memory.get('peak', 0))
+            if self.out is not None:
+                self.out.write(json.dumps(record) + '\n')
+                self.out.flush()
+    
+    def summary(self):
+        with self.lock:
+            wall_seconds = time.perf_counter() - self.started
+            summary = {'wall_s': round(wall_seconds, 3), 'files': dict(self.n_files), **self.totals,
+                       'rows_per_s': round(self.totals['rows_in'] / wall_seconds) if wall_seconds > 0 else None,
+                       'gz_mb_per_s': round(self.totals['bytes_in'] / MB / wall_seconds, 2) if wall_seconds > 0 else None,
+                       'csv_mb_per_s': round(self.totals['csv_bytes'] / MB / wall_seconds, 2) if wall_seconds > 0 else None,
+                       'stages_s': {stage: round(self.stage_totals[stage], 3) for stage in STAGES if stage in self.stage_totals},
+                       'peak_q_memory': self.peak_q_memory}
+        return summary
+    
+    def log_summary(self):
+        summary = self.summary()
+        logging.info(f"Ingested {summary['rows_in']} rows ({summary['rows_out']} kept) from {summary['files']} files in {summary['wall_s']}s: "
+                     f"{summary['rows_per_s']} rows/s, {summary['gz_mb_per_s']} MB/s gz, {summary['csv_mb_per_s']} MB/s csv, "
+                     f"peak Q memory {summary['peak_q_memory'] // MB} MB")
+        logging.info(f"Time per stage (s): {summary['stages_s']}")
+        return summary
+    
+    def close(self):
+        with self.lock:
+            if self.out is not None:
+                self.out.close()
+                self.out = None
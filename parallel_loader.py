@@ -0,0 +1,193 @@
+import os
+import time
+import socket
+import logging
+import argparse
+import threading
+import subprocess
+from datetime import datetime
+from collections import Counter
+from qpython import qconnection
+
+from feeds import FEEDS
+from manifest import IngestManifest
+from metrics import MetricsRecorder
+from qconn import ManagedQConnection
+from file_index import SourceIndex
+from scheduler import CostModel, WorkStealingScheduler
+from validate_hdb import validate_feeds
+from setup_kdb import EXTRACT_DIR, Q_PORT_NUMBER, STREAM_INGEST, setup_logging, add_selection_arguments, file_selection, feed_source_dir, \
+    feed_kdb_dir, feed_files_to_load, process_feed_file, date_string_from_file_name, sort_chunked_partition
+
+Q_EXE = "D:/q/w64/q"  # where the q executable lives (only needed when the loader starts its own Q processes)
+N_Q_THREADS = 4  # secondary threads for each Q process we start ourselves
+N_WORKERS = 4  # default number of Q processes loading in parallel
+Q_STARTUP_TIMEOUT = 30  # seconds we wait for a Q process to accept connections
+
+
+def launch_q(port_num, q_exe=Q_EXE, n_threads=N_Q_THREADS):
+    logging.info(f'Starting Q Process on port {port_num}')
+    return subprocess.Popen([q_exe, '-p', str(port_num), '-s', str(n_threads)],
+                            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_for_q(port_num, host='localhost', timeout=Q_STARTUP_TIMEOUT, q_process=None):
+    # probe the port until Q accepts the handshake and answers a trivial query, instead of sleeping and hoping
+    deadline = time.time() + timeout
+    while True:
+        q = ManagedQConnection(host=host, port=port_num)
+        try:
+            q.open()
+            if q.ping():
+                logging.info(f'Q on {host}:{port_num} is ready. IPC version: {q.protocol_version}')
+                return q
+        except (socket.error, qconnection.QConnectionException):
+            pass
+        q.close()
+        if q_process is not None and q_process.poll() is not None:
+            raise RuntimeError(f'Q process for port {port_num} exited with code {q_process.returncode} before accepting connections')
+        if time.time() > deadline:
+            raise TimeoutError(f'Q on {host}:{port_num} did not accept connections within {timeout}s')
+        time.sleep(0.1)
+
+
+def open_q_pool(ports, launch=False, q_exe=Q_EXE, host='localhost'):
+    # returns [(q connection, q process or None)], we start all processes first so they boot in parallel
+    q_processes = [launch_q(port_num, q_exe) if launch else None for port_num in ports]
+    pool = []
+    try:
+        for port_num, q_process in zip(ports, q_processes):
+            pool.append((wait_for_q(port_num, host=host, q_process=q_process), q_process))
+    except Exception:
+        close_q_pool(pool + [(None, p) for p in q_processes[len(pool):]])
+        raise
+    return pool
+
+
+def close_q_pool(pool):
+    for q, q_process in pool:
+        if q is not None:
+            if q_process is not None and q.is_connected():
+                try:
+                    q.sendAsync('exit 0')
+                except socket.error:
+                    pass
+            q.close()
+        if q_process is not None:
+            try:
+                q_process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                q_process.kill()
+
+
+def collect_work_units(feeds, manifest=None, source_index=None, selection=None, src_root=None, kdb_root=None):
+    # one work unit per source file still to load: (feed, source directory, file name), ordered like the sequential loader
+    work_units = []
+    for feed in feeds:
+        data_path = feed_source_dir(feed, src_root)
+        if not os.path.exists(data_path):
+            logging.error(f"Failed to open directory for reading: {data_path}")
+            continue
+        gz_csv_files = feed_files_to_load(feed, data_path, feed_kdb_dir(feed, kdb_root), manifest, selection, source_index)
+        work_units.extend((feed, data_path, x) for x in gz_csv_files)
+    return work_units
+
+
+def q_worker(q, worker, scheduler, failed_units, temp_dir, stream, manifest, metrics, kdb_root=None, dates_left=None):
+    # dates_left: (feed, date string) => files of the date not loaded yet (with its lock), the worker loading the last one sorts the
+    # partition of a chunked feed (sort_chunked_partition)
+    while True:
+        item = scheduler.next_item(worker)
+        if item is None:
+            return
+        feed, data_path, zipped_filename = item.unit
+        try:
+            if not process_feed_file(q, feed, zipped_filename, kdb_dir=feed_kdb_dir(feed, kdb_root), parent_dir=data_path, temp_dir=temp_dir,
+                                     stream=stream, manifest=manifest, metrics=metrics):
+                failed_units.append((feed, zipped_filename))
+        except Exception:
+            logging.exception(f'Failed to load {feed} file {zipped_filename}')
+            failed_units.append((feed, zipped_filename))
+        finally:
+            scheduler.done(item)
+        if dates_left is not None and FEEDS[feed].chunk_rows is not None:
+            counts, lock = dates_left
+            date_string = date_string_from_file_name(zipped_filename)
+            with lock:
+                counts[feed, date_string] -= 1
+                last = counts[feed, date_string] == 0
+            if last:
+                try:
+                    sort_chunked_partition(q, feed_kdb_dir(feed, kdb_root), date_string, FEEDS[feed].table, FEEDS[feed].partition_by)
+                except Exception:
+                    logging.exception(f'Failed to sort {feed} partition {date_string}')
+
+
+def load_parallel(pool, work_units, temp_dir=EXTRACT_DIR, stream=STREAM_INGEST, manifest=None, metrics=None, cost_model=None, source_index=None,
+                  worker_memory=None, memory_budget=None, kdb_root=None):
+    # the files are spread over the pool by estimated cost, largest first, see scheduler.py
+    cost_model = CostModel() if cost_model is None else cost_model
+    scheduler = WorkStealingScheduler(cost_model.work_items(work_units, source_index), len(pool), worker_memory, memory_budget)
+    failed_units = []
+    dates_left = (Counter((feed, date_string_from_file_name(x)) for feed, _, x in work_units), threading.Lock())
+    workers = [threading.Thread(target=q_worker, name=f'q-worker-{i}',
+                                args=(q, i, scheduler, failed_units, temp_dir, stream, manifest, metrics, kdb_root, dates_left))
+               for i, (q, _) in enumerate(pool)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    logging.info(f'{scheduler.n_stolen} files were stolen by idle workers')
+    return failed_units
+
+
+def gigabytes(value):
+    return None if value is None else int(value * 1024 ** 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load the EUX trade/order/book files into KDB with a pool of Q processes.')
+    parser.add_argument('--workers', type=int, default=N_WORKERS, help='number of Q processes loading in parallel')
+    parser.add_argument('--ports', type=int, nargs='*', help='ports of already running Q processes (default: consecutive ports from --base-port)')
+    parser.add_argument('--base-port', type=int, default=Q_PORT_NUMBER)
+    parser.add_argument('--launch', action='store_true', help='start the Q processes ourselves (needs a licence that allows it)')
+    parser.add_argument('--q-exe', default=Q_EXE)
+    add_selection_arguments(parser)
+    parser.add_argument('--worker-memory-gb', type=float, help='Q memory a worker may use for one file, larger files go to other workers')
+    parser.add_argument('--memory-budget-gb', type=float, help='Q memory the files loading at the same time may use together')
+    args = parser.parse_args()
+    selection = file_selection(args)
+    
+    setup_logging('upload_kdb_parallel', args.log_dir)
+    logging.info('Started')
+    
+    ports = args.ports if args.ports else [args.base_port + i for i in range(args.workers)]
+    manifest = IngestManifest(args.manifest)
+    metrics = MetricsRecorder(args.metrics)
+    source_index = SourceIndex(args.source_index)
+    work_units = collect_work_units(args.feeds, manifest, source_index, selection, args.src_root, args.kdb_root)
+    logging.info(f'Loading {len(work_units)} files with {len(ports)} Q processes on ports {ports}')
+    
+    pool = open_q_pool(ports, launch=args.launch, q_exe=args.q_exe)
+    run_started = datetime.now().isoformat()
+    try:
+        failed_units = load_parallel(pool, work_units, manifest=manifest, metrics=metrics, cost_model=CostModel(args.metrics),
+                                     source_index=source_index, worker_memory=gigabytes(args.worker_memory_gb),
+                                     memory_budget=gigabytes(args.memory_budget_gb), kdb_root=args.kdb_root)
+        if not args.no_validation:
+            validate_feeds([q for q, _ in pool], args.feeds, manifest, updated_since=run_started, kdb_root=args.kdb_root)
+    finally:
+        close_q_pool(pool)
+        source_index.save()
+        logging.info(f'Manifest (feed, status, files, rows): {manifest.summary()}')
+        manifest.close()
+        metrics.log_summary()
+        metrics.close()
+    if failed_units:
+        logging.error(f'Failed to load {len(failed_units)} files: {failed_units}')
+    
+    logging.info('Finished')
+
+
+if __name__ == '__main__':
+    main()
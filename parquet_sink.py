@@ -0,0 +1,92 @@
+import os
+import logging
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from qpython.qtype import QDATE, QTIMESTAMP, QINT
+
+from feeds import FEEDS, Q_INT_NULL, Q_LONG_NULL, Q_EPOCH_NANOS, Q_EPOCH_DAYS
+
+# a second store next to the HDB for readers without a Q licence: the columns the python engine builds for Q are also written, in the same
+# pass, to <root>/<hdb>/date=YYYY-MM-DD/<source file>.parquet (or .arrow, Arrow IPC files that readers can memory map without a copy);
+# one file per source file, so a reloaded file replaces its own, written under a temporary name and renamed once complete; each chunk is
+# sorted on sym and time and cut into row groups of ROW_GROUP_ROWS whose min/max statistics let readers skip on sym and time (the source
+# files hold one instrument each, so the files end up sym sorted as a whole); only the chunk being written is held in memory
+
+SINK_FORMAT = 'parquet'  # 'parquet' or 'arrow' (Arrow IPC file format)
+ROW_GROUP_ROWS = 250000  # rows per parquet row group / arrow record batch
+PARQUET_COMPRESSION = 'zstd'
+
+
+def arrow_table(parsed_chunk):
+    # the chunk as transform_chunk prepared it for Q => an arrow table, Q nulls as arrow nulls, symbols as strings
+    ordered_names, q_columns, symbol_indices, symbol_values, _ = parsed_chunk
+    symbol_values = dict(zip(symbol_indices, symbol_values))
+    arrays = []
+    for i, values in enumerate(q_columns):
+        values = np.asarray(values)
+        if i in symbol_values:
+            arrays.append(pa.DictionaryArray.from_arrays(values, pa.array(np.asarray(symbol_values[i]).astype(str))).dictionary_decode())
+        elif q_columns[i].meta.qtype == QTIMESTAMP:
+            arrays.append(pa.array(values + Q_EPOCH_NANOS, type=pa.timestamp('ns'), mask=values == Q_LONG_NULL))
+        elif q_columns[i].meta.qtype == QDATE:
+            arrays.append(pa.array(values + Q_EPOCH_DAYS, type=pa.date32(), mask=values == Q_INT_NULL))
+        elif q_columns[i].meta.qtype == QINT:
+            arrays.append(pa.array(values, type=pa.int32(), mask=values == Q_INT_NULL))
+        else:
+            arrays.append(pa.array(values, type=pa.float64()))
+    return pa.Table.from_arrays(arrays, names=list(ordered_names))
+
+
+class ColumnarSink:
+    def __init__(self, root_dir, file_format=SINK_FORMAT, row_group_rows=ROW_GROUP_ROWS, compression=PARQUET_COMPRESSION):
+        if file_format not in ('parquet', 'arrow'):
+            raise ValueError(f'Unknown sink format {file_format}, use parquet or arrow')
+        self.root_dir = root_dir
+        self.file_format = file_format
+        self.row_group_rows = row_group_rows
+        self.compression = compression
+        self.writer = None
+        self.path = None
+        self.temp_path = None
+    
+    def output_path(self, feed, full_input_filename, date_string):
+        source_name = os.path.basename(full_input_filename).split('.')[0]
+        return os.path.join(self.root_dir, FEEDS[feed].hdb, f"date={date_string.replace('.', '-')}",
+                            f'{source_name}.{self.file_format}').replace("\\", "/")
+    
+    def write_chunk(self, feed, full_input_filename, date_string, parsed_chunk):
+        table = arrow_table(parsed_chunk)
+        table = table.take(pc.sort_indices(table, sort_keys=[('sym', 'ascending'), ('time', 'ascending')]))
+        if self.writer is None:
+            self.path = self.output_path(feed, full_input_filename, date_string)
+            self.temp_path = self.path + '.tmp'
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            if self.file_format == 'parquet':
+                self.writer = pq.ParquetWriter(self.temp_path, table.schema, compression=self.compression, write_statistics=True)
+            else:
+                self.writer = pa.ipc.new_file(self.temp_path, table.schema)
+        if self.file_format == 'parquet':
+            self.writer.write_table(table, row_group_size=self.row_group_rows)
+        else:
+            self.writer.write_table(table, max_chunksize=self.row_group_rows)
+    
+    def finish_file(self):
+        # the file is complete, it replaces what an earlier load of the source wrote
+        if self.writer is None:
+            return None
+        self.writer.close()
+        os.replace(self.temp_path, self.path)
+        logging.info(f'Wrote {self.path}')
+        path, self.writer, self.path, self.temp_path = self.path, None, None, None
+        return path
+    
+    def abort_file(self):
+        # a file that failed half way is dropped, the next run loads it again
+        if self.writer is None:
+            return
+        self.writer.close()
+        if os.path.isfile(self.temp_path):
+            os.remove(self.temp_path)
+        self.writer, self.path, self.temp_path = None, None, None
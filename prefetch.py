@@ -0,0 +1,198 @@
+import gzip
+import zlib
+import queue
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+
+# a bounded producer/consumer pipeline: background threads prepare (decompress, copy, extract) the next files while the caller is busy
+# with Q on the current one, a byte budget caps how much prepared data may be waiting in memory or on disk
+
+END_OF_ITEM = object()
+BGZF_HEADER = struct.Struct('<4BI2BH2BH')  # gzip header of a BGZF block: magic, method, flags, mtime, xfl, os, xlen, 'B', 'C', slen
+BGZF_PARALLEL_BLOCKS = 64  # blocks inflated together by the decompression threads
+READ_BLOCK_SIZE = 1 << 20
+
+
+class ByteBudget:
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.head = 0  # index of the item the consumer is working on, it is never kept waiting (else we could deadlock)
+        self.cancelled = False
+        self.condition = threading.Condition()
+    
+    def reserve(self, n_bytes, index):
+        with self.condition:
+            while self.used > 0 and self.used + n_bytes > self.limit and index != self.head and not self.cancelled:
+                self.condition.wait()
+            if self.cancelled:
+                raise CancelledError()
+            self.used += n_bytes
+    
+    def release(self, n_bytes):
+        with self.condition:
+            self.used -= n_bytes
+            self.condition.notify_all()
+    
+    def advance(self, index):
+        with self.condition:
+            self.head = index
+            self.condition.notify_all()
+    
+    def cancel(self):
+        # the consumer went away, producers stop at their next reservation
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+
+def produce_into(item_queue, produce, item, reserve):
+    try:
+        for piece, n_bytes in produce(item, reserve):
+            item_queue.put((piece, n_bytes))
+    except BaseException as e:
+        item_queue.put(e)
+    item_queue.put(END_OF_ITEM)
+
+
+def consume_pieces(item_queue, budget):
+    # yields the pieces of one item, returning their bytes to the budget as the consumer moves on; if the consumer gives up half way the
+    # remaining pieces are drained so the producer is not left blocked
+    entry = None
+    try:
+        while True:
+            entry = item_queue.get()
+            if entry is END_OF_ITEM:
+                return
+            if isinstance(entry, BaseException):
+                raise entry
+            piece, n_bytes = entry
+            try:
+                yield piece
+            finally:
+                budget.release(n_bytes)
+    finally:
+        while entry is not END_OF_ITEM:
+            entry = item_queue.get()
+            if isinstance(entry, tuple):
+                budget.release(entry[1])
+
+
+def prefetch_in_order(items, produce, depth, budget_bytes):
+    # produce(item, reserve) yields (piece, n_bytes) and calls reserve(n_bytes) before handing over each piece (before building it where the
+    # size is known up front); up to depth items are produced ahead in background threads, we yield (item, iterator over its pieces) in
+    # the original order
+    items = list(items)
+    budget = ByteBudget(budget_bytes)
+    item_queues = [queue.Queue() for _ in items]
+    with ThreadPoolExecutor(max_workers=max(depth, 1), thread_name_prefix='prefetch') as executor:
+        def submit(index):
+            if index < len(items):
+                executor.submit(produce_into, item_queues[index], produce, items[index], lambda n_bytes: budget.reserve(n_bytes, index))
+        
+        try:
+            for index in range(max(depth, 1)):
+                submit(index)
+            for index, item in enumerate(items):
+                budget.advance(index)
+                pieces = consume_pieces(item_queues[index], budget)
+                try:
+                    yield item, pieces
+                finally:
+                    pieces.close()
+                    submit(index + max(depth, 1))
+        finally:
+            budget.cancel()
+
+
+def gzip_uncompressed_size(path):
+    # the gzip trailer holds the uncompressed size (mod 4GB) of the last member, good enough to budget an extraction
+    with open(path, 'rb') as f:
+        f.seek(-4, 2)
+        return struct.unpack('<I', f.read(4))[0]
+
+
+def bgzf_blocks(path):
+    # (offset, size) of every block if the file is BGZF (a multi-member gzip with the block sizes in its headers), else None
+    blocks = []
+    with open(path, 'rb') as f:
+        offset = 0
+        while True:
+            header = f.read(BGZF_HEADER.size)
+            if not header:
+                return blocks
+            if len(header) < BGZF_HEADER.size:
+                return None
+            id1, id2, method, flags, _, _, _, xlen, si1, si2, slen = BGZF_HEADER.unpack(header)
+            if (id1, id2, method) != (0x1f, 0x8b, 8) or not flags & 4 or (si1, si2, slen) != (66, 67, 2) or xlen != 6:
+                return None
+            block_size = struct.unpack('<H', f.read(2))[0] + 1
+            blocks.append((offset, block_size))
+            offset += block_size
+            f.seek(offset)
+
+
+def inflate_bgzf_block(data):
+    # skip the 18 byte header, the 8 byte trailer is ignored by raw inflate
+    return zlib.decompress(data[BGZF_HEADER.size + 2:], -15)
+
+
+def read_gz_blocks(path, executor=None):
+    # decompressed bytes of a gzip file; BGZF files are inflated block-parallel on the executor (zlib releases the GIL)
+    blocks = bgzf_blocks(path) if executor is not None else None
+    if not blocks:
+        with gzip.open(path, 'rb') as f_in:
+            for data in iter(lambda: f_in.read(READ_BLOCK_SIZE), b''):
+                yield data
+        return
+    with open(path, 'rb') as f:
+        for start in range(0, len(blocks), BGZF_PARALLEL_BLOCKS):
+            raw = []
+            for offset, block_size in blocks[start:start + BGZF_PARALLEL_BLOCKS]:
+                f.seek(offset)
+                raw.append(f.read(block_size))
+            yield b''.join(executor.map(inflate_bgzf_block, raw))
+
+
+def counted_lines(text, n_newlines):
+    # the lines of a chunk holding data (text has n_newlines \n): blank lines at its end are not counted, a last line without \n is
+    end = len(text)
+    while end > 0 and text[end - 1] in b'\r\n':
+        end -= 1
+    return 0 if end == 0 else n_newlines - text.count(b'\n', end) + 1
+
+
+def split_line_chunks(byte_blocks, chunk_lines):
+    # the decompressed blocks of a csv file => (header line, text, lines in text): text is the blocks cut at their last \n, joined until
+    # they hold chunk_lines lines (so up to one block more), for Q to split into lines (feeds.q_csv_lines); lines are only counted here,
+    # splitting them into python objects costs more than the rest of the stream; a full chunk waits for the next one, so the blank lines
+    # at the end of the file are not counted (the last chunk is the rest of the file as it is, its last line may have no \n)
+    header, pending, pieces, n_lines, rest = None, None, [], 0, b''
+    for data in byte_blocks:
+        if header is None:
+            rest = (rest + data).lstrip(b'\r\n')
+            end = rest.find(b'\n')
+            if end < 0:
+                continue
+            header, data, rest = rest[:end].rstrip(b'\r'), rest[end + 1:], b''
+        end = data.rfind(b'\n')
+        if end < 0:
+            rest += data
+            continue
+        # the blocks are only copied once, by the join of the chunk
+        pieces += [rest, memoryview(data)[:end + 1]]
+        rest = data[end + 1:]
+        n_lines += data.count(b'\n')
+        if n_lines >= chunk_lines:
+            if pending is not None:
+                yield pending
+            pending, pieces, n_lines = (header, b''.join(pieces), n_lines), [], 0
+    tail = b''.join(pieces + [rest])
+    n_tail = counted_lines(tail, n_lines)
+    if n_tail > 0:
+        if pending is not None:
+            yield pending
+        yield header, tail, n_tail
+    elif pending is not None and counted_lines(pending[1], pending[2]) > 0:
+        yield header, pending[1], counted_lines(pending[1], pending[2])
@@ -0,0 +1,255 @@
+import os
+import gzip
+import queue
+import logging
+import threading
+import numpy as np
+import pandas as pd
+from qpython.qcollection import qlist
+from qpython.qtype import QSYMBOL_LIST, QINT_LIST, QLONG_LIST, QDOUBLE_LIST, QDATE_LIST, QTIMESTAMP_LIST
+
+from feeds import FEEDS, SYM_SOURCE_COLUMN, Q_INT_NULL, Q_LONG_NULL, type_string
+from manifest import COMPLETE
+from metrics import FileMetrics, q_memory, partition_size
+from prefetch import gzip_uncompressed_size
+from setup_kdb import date_string_from_file_name, find_pattern_files, plan_feed_files, write_partition, partition_write_lock, append_block, \
+    index_partition, sort_chunked_partition
+
+# the same parsing and cleaning as the process_*_file functions, but done with pandas/numpy on our side so that the (licence limited) Q
+# process only receives ready columns and writes the partition
+
+PARSE_CHUNK_ROWS = 500000  # rows parsed and pushed to Q per IPC message
+PREFETCH_CHUNKS = 4  # parsed chunks kept ready while Q is busy with the previous chunk/partition
+
+Q_EPOCH_DATE = np.datetime64('2000-01-01', 'D')
+NANOS_PER_DAY = 86400 * 1000000000
+
+# q type char from the 0: type strings => pandas dtype used by read_csv; ints are read as float64 (NaN for the empty fields) and cast in
+# numpy, pandas' nullable Int32 goes through its slow object path and parses several times slower
+PARSE_DTYPES = {'S': 'category', 'D': 'category', 'I': 'float64', 'F': 'float64'}
+
+# the q comparisons used by the keep filters of the feed schemas
+COMPARISONS = {'=': np.equal, '<>': np.not_equal, '<': np.less, '<=': np.less_equal, '>': np.greater, '>=': np.greater_equal}
+
+
+def read_header(full_input_filename):
+    with gzip.open(full_input_filename, 'rb') as f_in:
+        return f_in.readline().decode('latin-1').rstrip("\r\n").split("|")
+
+
+def q_dates(date_column):
+    # dates are few and repeated, so we only parse the distinct values ("2017.05.02", "2017-05-02" and "20170502" all work, like 0:)
+    days = pd.to_datetime(date_column.cat.categories.str.replace(r'\D', '', regex=True), format='%Y%m%d').values.astype('datetime64[D]')
+    days = (days - Q_EPOCH_DATE).astype(np.int32)
+    codes = date_column.cat.codes.to_numpy()
+    return np.where(codes < 0, Q_INT_NULL, days[codes])
+
+
+def q_timestamps(date_days, time_sec, time_mm):
+    # Date + `second$(HHMMSS) + 1000*TimeMM, exactly as the Q update statement, as nanoseconds since 2000.01.01
+    is_null = (date_days == Q_INT_NULL) | (time_sec == Q_INT_NULL) | (time_mm == Q_INT_NULL)
+    time_sec = time_sec.astype(np.int64)
+    seconds = 3600 * (time_sec // 10000) + 60 * ((time_sec % 10000) // 100) + time_sec % 100
+    nanos = date_days.astype(np.int64) * NANOS_PER_DAY + seconds * 1000000000 + 1000 * time_mm.astype(np.int64)
+    nanos[is_null] = Q_LONG_NULL
+    return nanos
+
+
+def to_numpy_columns(chunk, names, types):
+    # returns name => numpy array (Q null sentinels instead of NaN for ints) and name => pandas categorical for the symbol columns
+    columns, symbols = {}, {}
+    for name, q_type in zip(names, types):
+        if q_type == 'S':
+            symbols[name] = chunk[name]
+            columns[name] = chunk[name].cat.codes.to_numpy()
+        elif q_type == 'D':
+            columns[name] = q_dates(chunk[name])
+        elif q_type == 'I':
+            values = chunk[name].to_numpy()
+            columns[name] = np.where(np.isnan(values), Q_INT_NULL, values).astype(np.int32)
+        else:
+            columns[name] = chunk[name].to_numpy(dtype=np.float64)
+    return columns, symbols
+
+
+def keep_mask(schema, columns):
+    keep = np.ones(len(columns[SYM_SOURCE_COLUMN]), dtype=bool)
+    for column, comparison, value in schema.keep:
+        keep &= COMPARISONS[comparison](columns[column], value)
+    return keep
+
+
+def transform_chunk(feed, chunk, names):
+    schema = FEEDS[feed]
+    columns, symbols = to_numpy_columns(chunk, names, type_string(schema))
+    columns['sym'] = columns[SYM_SOURCE_COLUMN]
+    symbols['sym'] = symbols[SYM_SOURCE_COLUMN]
+    columns['time'] = q_timestamps(*[columns[x] for x in schema.time_columns])
+    keep = keep_mask(schema, columns)
+    
+    q_types = dict(zip(names, type_string(schema)), sym='S', time='P')
+    ordered_names = schema.first_columns + [x for x in names if x not in schema.first_columns and x not in schema.drop]
+    q_columns, symbol_indices, symbol_values = [], [], []
+    for i, name in enumerate(ordered_names):
+        values = columns[name][keep]
+        q_type = q_types[name]
+        if q_type == 'S':
+            # symbols travel as int codes plus the distinct values, Q maps them back with one index operation
+            symbol_indices.append(i)
+            symbol_values.append(qlist(np.asarray(symbols[name].cat.categories, dtype='S'), qtype=QSYMBOL_LIST))
+            q_columns.append(qlist(values.astype(np.int32), qtype=QINT_LIST))
+        elif q_type == 'P':
+            q_columns.append(qlist(values, qtype=QTIMESTAMP_LIST))
+        elif q_type == 'D':
+            q_columns.append(qlist(values, qtype=QDATE_LIST))
+        elif q_type == 'I':
+            q_columns.append(qlist(values, qtype=QINT_LIST))
+        else:
+            q_columns.append(qlist(values, qtype=QDOUBLE_LIST))
+    return ordered_names, q_columns, symbol_indices, symbol_values, int(keep.sum())
+
+
+def parse_file(feed, full_input_filename, chunk_rows=PARSE_CHUNK_ROWS):
+    # yields (rows read, ready-to-push chunk) for the chunks of one source file
+    names = read_header(full_input_filename)
+    dtypes = {name: PARSE_DTYPES[q_type] for name, q_type in zip(names, type_string(FEEDS[feed]))}
+    with pd.read_csv(full_input_filename, sep='|', compression='gzip', dtype=dtypes, chunksize=chunk_rows, na_filter=True) as reader:
+        for chunk in reader:
+            yield len(chunk), transform_chunk(feed, chunk, names)
+
+
+def push_chunk(q, table_name, parsed_chunk, first):
+    assign = f'{table_name}::flip c!d' if first else f'`{table_name} upsert flip c!d'
+    send_columns(q, assign, parsed_chunk)
+
+
+def append_chunk(q, kdb_dir, date_string, table_name, parsed_chunk):
+    # chunked feeds: the chunk goes straight to the date partition on disk, Q only ever holds one chunk
+    send_columns(q, '.ingest.block:flip c!d', parsed_chunk)
+    append_block(q, kdb_dir, date_string, table_name)
+
+
+def send_columns(q, statement, parsed_chunk):
+    # statement runs with the column names c and the columns d, symbol columns already mapped back from their codes; sent async, errors
+    # surface with the sync of the partition write
+    ordered_names, q_columns, symbol_indices, symbol_values, _ = parsed_chunk
+    q.send_async(f'{{[c;d;si;su] d[si]:su@\'d si; {statement}}}', qlist(np.array(ordered_names, dtype='S'), qtype=QSYMBOL_LIST), q_columns,
+                 qlist(np.array(symbol_indices, dtype=np.int64), qtype=QLONG_LIST), symbol_values)
+
+
+def parse_files(feed, full_input_filenames, parsed_queue, chunk_rows=PARSE_CHUNK_ROWS):
+    # producer: (file, metrics, chunk) for every chunk, (file, metrics, None) once a file is complete, None at the very end
+    try:
+        for full_input_filename in full_input_filenames:
+            logging.info(f"Parsing {full_input_filename}")
+            file_metrics = FileMetrics(feed, full_input_filename, 'python')
+            file_metrics.csv_bytes = gzip_uncompressed_size(full_input_filename)
+            for rows_in, parsed_chunk in file_metrics.timed_items('parse', parse_file(feed, full_input_filename, chunk_rows)):
+                file_metrics.rows_in += rows_in
+                parsed_queue.put((full_input_filename, file_metrics, parsed_chunk))
+            parsed_queue.put((full_input_filename, file_metrics, None))
+    except Exception as e:
+        logging.exception(f'Failed to parse {feed} files')
+        parsed_queue.put(e)
+        return
+    parsed_queue.put(None)
+
+
+def process_files_py(q, feed, zipped_filenames, kdb_dir, parent_dir=None, chunk_rows=PARSE_CHUNK_ROWS, prefetch_chunks=PREFETCH_CHUNKS,
+                     manifest=None, metrics=None, sink=None):
+    # the parser thread runs ahead (bounded by prefetch_chunks) so the next file is parsed while Q writes the previous partition
+    # sink: a parquet_sink.ColumnarSink the chunks are written to as well
+    schema = FEEDS[feed]
+    chunk_rows = chunk_rows if schema.chunk_rows is None else schema.chunk_rows
+    full_input_filenames = [x if parent_dir is None else os.path.join(parent_dir, x).replace("\\", "/") for x in zipped_filenames]
+    parsed_queue = queue.Queue(maxsize=prefetch_chunks)
+    parser = threading.Thread(target=parse_files, name=f'parse-{feed}', args=(feed, full_input_filenames, parsed_queue, chunk_rows), daemon=True)
+    parser.start()
+    
+    # a file that never reaches the end (parser or Q failure) stays 'started' in the manifest and gets its partition rewritten next run;
+    # there is no retry after a lost connection here, the parser has moved on
+    # a chunked file keeps the lock of its date partition from its first block until the partition has its p# again, a date is sorted
+    # once the files of the next one start (the files come sorted by name, so by date)
+    loaded_files, n_rows, started_file, started_date = [], 0, None, None
+    write_lock, locked = None, False
+    try:
+        while True:
+            item = parsed_queue.get()
+            if item is None:
+                if schema.chunk_rows is not None and started_date is not None:
+                    sort_chunked_partition(q, kdb_dir, started_date, schema.table, schema.partition_by)
+                break
+            if isinstance(item, Exception):
+                raise item
+            full_input_filename, file_metrics, parsed_chunk = item
+            date_string = date_string_from_file_name(full_input_filename)
+            if started_file != full_input_filename:
+                if schema.chunk_rows is not None and started_date not in (None, date_string):
+                    sort_chunked_partition(q, kdb_dir, started_date, schema.table, schema.partition_by)
+                started_date = date_string
+                file_metrics.start()  # the parser thread created it when it began the file, possibly while we wrote the previous one
+                q.ensure_connected()
+                if manifest is not None:
+                    manifest.mark_started(full_input_filename, kdb_dir, feed, date_string)
+                started_file = full_input_filename
+            if parsed_chunk is None:
+                stats = None
+                if n_rows == 0:
+                    logging.error(f'No rows left to load from {full_input_filename}')
+                else:
+                    with file_metrics.stage('write'):
+                        if schema.chunk_rows is not None:
+                            stats = index_partition(q, kdb_dir, date_string, schema.table, schema.partition_by)
+                        else:
+                            stats = write_partition(q, kdb_dir, date_string, schema.table, schema.partition_by)
+                    if sink is not None:
+                        with file_metrics.stage('export'):
+                            sink.finish_file()
+                    logging.info(f"Loaded {n_rows} rows from {full_input_filename}")
+                    loaded_files.append(full_input_filename)
+                if locked:
+                    write_lock.release()
+                    locked = False
+                if metrics is not None:
+                    file_metrics.date, file_metrics.rows_out = date_string, n_rows
+                    if n_rows > 0:
+                        file_metrics.bytes_out = partition_size(kdb_dir, date_string, schema.table)
+                        file_metrics.q_memory = q_memory(q)
+                    file_metrics.finish(COMPLETE)
+                    metrics.record(file_metrics)
+                if manifest is not None:
+                    manifest.mark_complete(full_input_filename, kdb_dir, feed, date_string, n_rows, stats)
+                n_rows = 0
+                continue
+            if parsed_chunk[-1] == 0:
+                continue
+            with file_metrics.stage('push'):
+                if schema.chunk_rows is not None:
+                    if not locked:
+                        write_lock = partition_write_lock(kdb_dir, date_string)
+                        write_lock.acquire()
+                        locked = True
+                        q.send_async('.ingest.stats:()')
+                    append_chunk(q, kdb_dir, date_string, schema.table, parsed_chunk)
+                else:
+                    push_chunk(q, schema.table, parsed_chunk, first=n_rows == 0)
+            if sink is not None:
+                with file_metrics.stage('export'):
+                    sink.write_chunk(feed, full_input_filename, date_string, parsed_chunk)
+            n_rows += parsed_chunk[-1]
+    finally:
+        if locked:
+            write_lock.release()
+        if sink is not None:
+            sink.abort_file()
+    parser.join()
+    return loaded_files
+
+
+def process_pattern_fileBatch_py(toMatchPattern, feed, q, data_path, kdb_dir, chunk_rows=PARSE_CHUNK_ROWS, manifest=None, metrics=None,
+                                 source_index=None, sink=None):
+    gz_csv_files = find_pattern_files(toMatchPattern, data_path, source_index)
+    if not gz_csv_files:
+        return False
+    process_files_py(q, feed, plan_feed_files(manifest, feed, data_path, gz_csv_files, kdb_dir), kdb_dir, parent_dir=data_path, chunk_rows=chunk_rows,
+                     manifest=manifest, metrics=metrics, sink=sink)
@@ -0,0 +1,100 @@
+import time
+import socket
+import struct
+import logging
+from qpython import qconnection
+from qpython.qreader import QReaderException
+from qpython.qtype import QException
+
+# a QConnection that survives a multi-hour run: it checks the connection before each file, reconnects with backoff when it drops, and
+# lets a file's statements go out as async messages (no round trip each) that are checked with the one sync at the end of the file
+
+RECONNECT_ATTEMPTS = 8  # attempts before we give up on a Q process
+RECONNECT_BACKOFF = 1.0  # seconds before the first attempt, doubled after every failed one
+RECONNECT_MAX_BACKOFF = 60.0
+
+# async messages are not answered, so their errors are trapped and kept in Q until the next sync of the connection reports them
+Q_ASYNC = '{[s;a] .[{$[count y; (value x) . y; value x]}; (s;a); {.ingest.errors:@[value;`.ingest.errors;()],enlist x}]}'
+Q_SYNC = '{[s;a] if[count e:@[value;`.ingest.errors;()]; .ingest.errors:(); \'"; " sv e]; $[count a; (value s) . a; value s]}'
+
+CONNECTION_ERRORS = (socket.error, EOFError, struct.error, qconnection.QConnectionException, QReaderException)
+
+
+class QConnectionLost(qconnection.QConnectionException):
+    # the connection dropped and was opened again; whatever was sent since the last sync may not have reached Q, so the caller has to
+    # redo its unit of work (a file)
+    pass
+
+
+class ManagedQConnection:
+    def __init__(self, host='localhost', port=40000, attempts=RECONNECT_ATTEMPTS, backoff=RECONNECT_BACKOFF, max_backoff=RECONNECT_MAX_BACKOFF,
+                 **options):
+        self.host = host
+        self.port = port
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.options = options
+        self.q = qconnection.QConnection(host=host, port=port, **options)
+        self.reconnects = 0
+    
+    def __getattr__(self, name):
+        # protocol_version, is_connected, sendAsync ... of the current QConnection
+        return getattr(self.q, name)
+    
+    def open(self):
+        self.q.open()
+    
+    def close(self):
+        self.q.close()
+    
+    def ping(self):
+        try:
+            self.q.sendSync('1b')
+            return True
+        except CONNECTION_ERRORS:
+            return False
+    
+    def reconnect(self):
+        self.q.close()
+        delay = self.backoff
+        for attempt in range(1, self.attempts + 1):
+            logging.warning(f'Reconnecting to Q on {self.host}:{self.port} in {delay}s (attempt {attempt} of {self.attempts})')
+            time.sleep(delay)
+            self.q = qconnection.QConnection(host=self.host, port=self.port, **self.options)
+            try:
+                self.q.open()
+                if self.ping():
+                    self.reconnects += 1
+                    logging.info(f'Reconnected to Q on {self.host}:{self.port}')
+                    return
+            except CONNECTION_ERRORS:
+                pass
+            self.q.close()
+            delay = min(2 * delay, self.max_backoff)
+        raise qconnection.QConnectionException(f'Could not reconnect to Q on {self.host}:{self.port} after {self.attempts} attempts')
+    
+    def ensure_connected(self):
+        # the health check before each unit of work, a dead connection is replaced before we start sending
+        if not self.q.is_connected() or not self.ping():
+            self.reconnect()
+    
+    def _send(self, send, query, parameters):
+        try:
+            return send(query, *parameters)
+        except QException:
+            raise
+        except CONNECTION_ERRORS as e:
+            logging.warning(f'Lost the connection to Q on {self.host}:{self.port}: {e!r}')
+            self.reconnect()
+            raise QConnectionLost(f'Connection to Q on {self.host}:{self.port} was lost and reopened') from e
+    
+    def send_async(self, query, *parameters):
+        self._send(self.q.sendAsync, Q_ASYNC, [query, list(parameters)])
+    
+    def sync(self, query, *parameters):
+        # raises a QException with the failures of the async messages sent since the last sync, else returns the result of query
+        return self._send(self.q.sendSync, Q_SYNC, [query, list(parameters)])
+    
+    def __call__(self, query, *parameters):
+        return self.sync(query, *parameters)
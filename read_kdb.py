@@ -0,0 +1,240 @@
+import os
+import re
+import numpy as np
+from qpython.qcollection import qlist
+from qpython.qtype import QSYMBOL_LIST, QLONG_LIST
+
+from feeds import FEEDS, Q_INT_NULL, Q_LONG_NULL, Q_EPOCH_NANOS, Q_EPOCH_DAYS
+from setup_kdb import feed_kdb_dir, partition_table_dir
+
+# reading the loaded tables back into numpy without going through pandas: for (feed, date range, syms, columns) the rows come in chunks
+# of plain arrays, either memory mapped straight from the splayed column files of the HDB (no Q needed, the partition is sorted and
+# p# on sym so the rows of a sym are one slice of each column file) or over IPC from a Q process (for an HDB on another machine), where
+# each chunk is one vector per column; read_table fills arrays allocated once for the whole result; the columns of a partition are the
+# ones its .d file lists, with the types their files (or Q's meta) give
+#   sym/symbol columns : numpy bytes ('S'), timestamps : datetime64[ns], dates : datetime64[D], int : int32, float : float64
+
+READ_CHUNK_ROWS = 1000000  # rows per chunk handed out by read_partitions
+
+DATE_DIRECTORY_PATTERN = re.compile(r'^\d{4}\.\d{2}\.\d{2}$')
+
+# q type char => (numpy dtype on disk, q type number), symbol columns are stored enumerated against the sym file of the HDB
+DISK_TYPES = {'S': (np.int32, 20), 'P': (np.int64, 12), 'D': (np.int32, 14), 'I': (np.int32, 6), 'J': (np.int64, 7), 'F': (np.float64, 9),
+              'E': (np.float32, 8)}
+OUTPUT_DTYPES = {'P': 'datetime64[ns]', 'D': 'datetime64[D]', 'I': np.int32, 'J': np.int64, 'F': np.float64, 'E': np.float32}
+TYPE_CHARS = {number: q_type for q_type, (_, number) in DISK_TYPES.items()}  # q type number of a column file => q type char
+
+
+def column_file_header(path):
+    # (q type, attribute, rows, offset of the data) of a column file written by set/.Q.dpft, kdb+ 3 (16 byte header) or older (8 bytes)
+    with open(path, 'rb') as f_in:
+        header = f_in.read(16)
+        f_in.seek(-8, os.SEEK_END)
+        if f_in.read(8) == b'kxzipped':
+            raise ValueError(f'{path} is compressed, read it over IPC instead')
+    if header[:2] == b'\xfe\x20':
+        return header[2], header[3], int(np.frombuffer(header, np.int64, 1, 8)[0]), 16
+    if header[:2] == b'\xff\x01':
+        return header[2], header[3], int(np.frombuffer(header, np.int32, 1, 4)[0]), 8
+    raise ValueError(f'{path} is not a Q column file')
+
+
+def map_column(path, q_type):
+    q_type_number, _, n_rows, offset = column_file_header(path)
+    dtype, expected_type = DISK_TYPES[q_type]
+    if q_type_number != expected_type and not (q_type == 'S' and 20 <= q_type_number <= 76):
+        raise ValueError(f'{path} holds Q type {q_type_number}, expected {expected_type}')
+    if n_rows == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(n_rows,))
+
+
+def column_type(path):
+    # q type char of a column file, symbol columns are enumerations (types 20-76)
+    q_type_number = column_file_header(path)[0]
+    if 20 <= q_type_number <= 76:
+        return 'S'
+    if q_type_number not in TYPE_CHARS:
+        raise ValueError(f'{path} holds Q type {q_type_number}, which we do not read')
+    return TYPE_CHARS[q_type_number]
+
+
+def read_symbol_file(path):
+    # a symbol list file (the sym file of the HDB, the .d file of a splayed table): header, then the symbols as 0 terminated strings
+    with open(path, 'rb') as f_in:
+        data = f_in.read()
+    if data[:2] == b'\xfe\x20':
+        n_syms, offset = int(np.frombuffer(data, np.int64, 1, 8)[0]), 16
+    else:
+        n_syms, offset = int(np.frombuffer(data, np.int32, 1, 4)[0]), 8
+    return np.array(data[offset:].split(b'\0')[:n_syms], dtype='S')
+
+
+def read_sym_file(kdb_dir):
+    # the enumeration domain of the HDB
+    return read_symbol_file(os.path.join(kdb_dir, 'sym').replace("\\", "/"))
+
+
+def sym_indices_of(symbols, syms):
+    # positions of syms in the sym file, None selects every row
+    if syms is None:
+        return None
+    wanted = set(np.array(syms, dtype='S'))
+    return np.array([i for i, x in enumerate(symbols) if x in wanted], dtype=np.int32)
+
+
+def typed_column(q_type, values, symbols=None):
+    # Q encoded values => the output dtype, enumerated symbols are looked up in symbols (the sym file)
+    if q_type == 'S':
+        return values if symbols is None else symbols[values]
+    if q_type == 'P':
+        return np.where(values == Q_LONG_NULL, Q_LONG_NULL, values + Q_EPOCH_NANOS).view('datetime64[ns]')
+    if q_type == 'D':
+        return np.where(values == Q_INT_NULL, np.iinfo(np.int64).min, values.astype(np.int64) + Q_EPOCH_DAYS).view('datetime64[D]')
+    return np.asarray(values)
+
+
+def table_layout(kdb_dir, date_string, table_name, q=None):
+    # [(name, q type char)] of the splayed table of a partition in its column order: the names from its .d file and the types from the
+    # headers of the column files, or both from Q's meta of the table
+    table_dir = partition_table_dir(kdb_dir, date_string, table_name)
+    if q is None:
+        return [(name, column_type(table_dir + name)) for name in read_symbol_file(table_dir + '.d').astype(str)]
+    names, q_types = q.sendSync(f'{{m:0!meta get x; (m`c; m`t)}}`:{table_dir}')
+    return [(name.decode(), chr(q_type).upper()) for name, q_type in zip(names, q_types)]
+
+
+def selected_columns(layout, columns=None, where=''):
+    if columns is None:
+        return layout
+    q_types = dict(layout)
+    unknown = [x for x in columns if x not in q_types]
+    if unknown:
+        raise ValueError(f'{where} has no columns {unknown}, it has {list(q_types)}')
+    return [(x, q_types[x]) for x in columns]
+
+
+def partition_dates(kdb_dir, start_date=None, end_date=None, q=None):
+    # the date partitions of the HDB between start_date and end_date (YYYY.MM.DD, inclusive), from the disk or from Q
+    if q is None:
+        names = os.listdir(kdb_dir) if os.path.isdir(kdb_dir) else []
+    else:
+        names = [x.decode() for x in q.sendSync(f'key `:{kdb_dir}')]
+    return sorted(x for x in names if DATE_DIRECTORY_PATTERN.match(x) and (start_date is None or x >= start_date) and
+                  (end_date is None or x <= end_date))
+
+
+def row_runs(sym_column, sym_indices):
+    # [(start, stop)] of the rows whose sym is one of sym_indices, None for all of them; p# keeps each sym in one run
+    if sym_indices is None:
+        return [(0, len(sym_column))]
+    rows = np.flatnonzero(np.isin(sym_column, sym_indices))
+    if len(rows) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+    return [(int(x[0]), int(x[-1]) + 1) for x in np.split(rows, breaks)]
+
+
+def chunk_runs(runs, chunk_rows):
+    for start, stop in runs:
+        for chunk_start in range(start, stop, chunk_rows):
+            yield chunk_start, min(chunk_start + chunk_rows, stop)
+
+
+def mapped_partition(kdb_dir, date_string, schema, columns, sym_indices):
+    # (column name => memory mapped column, row runs of the syms) of one partition, columns as selected_columns returns them
+    table_dir = partition_table_dir(kdb_dir, date_string, schema.table)
+    mapped = {name: map_column(table_dir + name, q_type) for name, q_type in columns}
+    sym_column = mapped['sym'] if 'sym' in mapped else map_column(table_dir + 'sym', 'S')
+    return mapped, row_runs(sym_column, sym_indices)
+
+
+def q_fetch_rows(kdb_dir, date_string, table_name):
+    # [c;a;b]: the columns c of the rows a ... b-1, enumerations as their positions in the sym file (mapped back on our side, the sym of the
+    # Q session may be the domain of another HDB)
+    return f'{{[c;a;b] {{$[type[x] within 20 76h; "j"$x; x]}} each value flip (c#get `:{partition_table_dir(kdb_dir, date_string, table_name)}) a+til b-a}}'
+
+
+def q_row_runs(kdb_dir, date_string, table_name):
+    # [s]: (starts; stops) of the runs of rows whose sym is at one of the positions s of the sym file, read once per partition
+    return f'{{[s] w:where ("j"$get[`:{partition_table_dir(kdb_dir, date_string, table_name)}]`sym) in s; e:where 1<>1_deltas w; ' \
+           f'$[count w; (w 0,1+e; 1+w e,-1+count w); 2#enlist "j"$()]}}'
+
+
+def symbol_list(values):
+    return qlist(np.array(values, dtype='S'), qtype=QSYMBOL_LIST)
+
+
+def read_partitions(feed, start_date=None, end_date=None, syms=None, columns=None, kdb_dir=None, chunk_rows=READ_CHUNK_ROWS, q=None):
+    # yields (date string, column name => array) chunks of at most chunk_rows rows, in date and sym order; without q the chunks of
+    # numeric columns are views of the memory mapped files, so they stay valid only as long as the files are not rewritten
+    schema = FEEDS[feed]
+    kdb_dir = feed_kdb_dir(feed) if kdb_dir is None else kdb_dir
+    if q is not None:
+        yield from fetch_partitions(q, kdb_dir, schema, start_date, end_date, syms, columns, chunk_rows)
+        return
+    symbols = read_sym_file(kdb_dir)
+    sym_indices = sym_indices_of(symbols, syms)
+    for date_string in partition_dates(kdb_dir, start_date, end_date):
+        selection = selected_columns(table_layout(kdb_dir, date_string, schema.table), columns, f'{feed} {date_string}')
+        mapped, runs = mapped_partition(kdb_dir, date_string, schema, selection, sym_indices)
+        for start, stop in chunk_runs(runs, chunk_rows):
+            yield date_string, {name: typed_column(q_type, mapped[name][start:stop], symbols) for name, q_type in selection}
+
+
+def fetch_partitions(q, kdb_dir, schema, start_date, end_date, syms, columns, chunk_rows):
+    # the IPC side of read_partitions: the sym file comes over once, the row runs of the syms once per partition, then Q maps the
+    # partition and sends one chunk (a slice of a run) per round trip, without pandas on our side
+    symbols = fetch_sym_file(q, kdb_dir)
+    sym_indices = sym_indices_of(symbols, syms)
+    for date_string in partition_dates(kdb_dir, start_date, end_date, q):
+        selection = selected_columns(table_layout(kdb_dir, date_string, schema.table, q), columns, f'{schema.name} {date_string}')
+        column_names = symbol_list([name for name, _ in selection])
+        query = q_fetch_rows(kdb_dir, date_string, schema.table)
+        for start, stop in chunk_runs(fetch_row_runs(q, kdb_dir, date_string, schema, sym_indices), chunk_rows):
+            values = q.sendSync(query, column_names, np.int64(start), np.int64(stop))
+            yield date_string, {name: typed_column(q_type, np.asarray(x), symbols) for (name, q_type), x in zip(selection, values)}
+
+
+def fetch_sym_file(q, kdb_dir):
+    return np.array(q.sendSync(f'get `:{kdb_dir}/sym'), dtype='S')
+
+
+def fetch_row_runs(q, kdb_dir, date_string, schema, sym_indices):
+    # like row_runs, over IPC
+    if sym_indices is None:
+        return [(0, int(q.sendSync(f'count get `:{partition_table_dir(kdb_dir, date_string, schema.table)}')))]
+    starts, stops = q.sendSync(q_row_runs(kdb_dir, date_string, schema.table), qlist(sym_indices.astype(np.int64), qtype=QLONG_LIST))
+    return list(zip(map(int, starts), map(int, stops)))
+
+
+def read_table(feed, start_date=None, end_date=None, syms=None, columns=None, kdb_dir=None, chunk_rows=READ_CHUNK_ROWS, q=None):
+    # the whole selection as column name => array, numeric columns allocated once with the row count of the selection and filled chunk
+    # by chunk (symbol columns are joined at the end, their width is only known once they are read); the types are those of the first
+    # partition of the range
+    schema = FEEDS[feed]
+    kdb_dir = feed_kdb_dir(feed) if kdb_dir is None else kdb_dir
+    dates = partition_dates(kdb_dir, start_date, end_date, q)
+    if not dates:
+        return {}
+    selection = selected_columns(table_layout(kdb_dir, dates[0], schema.table, q), columns, f'{feed} {dates[0]}')
+    if q is None:
+        sym_indices = sym_indices_of(read_sym_file(kdb_dir), syms)
+        n_rows = sum(stop - start for date_string in dates for start, stop in mapped_partition(kdb_dir, date_string, schema, [], sym_indices)[1])
+    else:
+        sym_indices = sym_indices_of(fetch_sym_file(q, kdb_dir), syms)
+        n_rows = sum(stop - start for date_string in dates for start, stop in fetch_row_runs(q, kdb_dir, date_string, schema, sym_indices))
+    table = {name: np.empty(n_rows, dtype=OUTPUT_DTYPES[q_type]) for name, q_type in selection if q_type != 'S'}
+    symbol_chunks = {name: [] for name, q_type in selection if q_type == 'S'}
+    n_filled = 0
+    for _, chunk in read_partitions(feed, start_date, end_date, syms, columns, kdb_dir, chunk_rows, q):
+        n_chunk = len(next(iter(chunk.values()))) if chunk else 0
+        for name, values in chunk.items():
+            if name in symbol_chunks:
+                symbol_chunks[name].append(values)
+            else:
+                table[name][n_filled:n_filled + n_chunk] = values
+        n_filled += n_chunk
+    for name, chunks in symbol_chunks.items():
+        table[name] = np.concatenate(chunks) if chunks else np.empty(0, dtype='S1')
+    return {name: table[name][:n_filled] for name, _ in selection}
@@ -0,0 +1,161 @@
+import os
+import json
+import logging
+import threading
+from collections import deque, namedtuple
+
+from feeds import FEEDS
+
+# hands the files of a parallel load to the Q workers so that they finish together: every file gets a cost (seconds) and a Q memory
+# estimate from its compressed size and what the metrics file (metrics.py) recorded for earlier loads, the files are dealt out largest
+# first to the least loaded worker (LPT), each worker works through its own list from the largest file down, and a worker that runs out
+# steals the smallest files left on the most loaded one; a file only starts when its memory estimate fits the memory limit of the worker
+# and, with memory_budget, what the files running on the other workers leave of the budget (two expiry day book files do not run at
+# the same time on a box that cannot hold both)
+
+DEFAULT_SECONDS_PER_MB = 0.5  # compressed MB, until the metrics file has a history for the feed
+DEFAULT_EXPANSION = 6.0  # csv bytes per compressed byte
+DEFAULT_CSV_BYTES_PER_ROW = 150
+Q_MEMORY_PER_CSV_BYTE = 1.5  # Q holds the parsed columns and the transformed table while loading a whole file
+MB = 1 << 20
+
+WorkItem = namedtuple('WorkItem', ['unit', 'cost', 'memory'])  # unit: (feed, source directory, file name) of collect_work_units
+
+
+class CostModel:
+    def __init__(self, metrics_path=None):
+        # metrics_path: json lines of metrics.MetricsRecorder, the complete loads in it calibrate the estimates
+        self.seconds_per_byte = {}  # feed => seconds of work (the stages of a load) per compressed byte
+        self.expansion = {}  # feed => csv bytes per compressed byte
+        self.csv_bytes_per_row = {}
+        self.file_seconds = {}  # source path => seconds of work of its last complete load
+        if metrics_path is not None and os.path.isfile(metrics_path):
+            self.load_history(metrics_path)
+    
+    def load_history(self, metrics_path):
+        # a file's cost is the sum of its stages, its wall time also counts waiting on the other workers for the partition lock
+        totals = {}
+        with open(metrics_path) as f_in:
+            for line in f_in:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('status') != 'complete' or not record.get('bytes_in') or not record.get('stages_s'):
+                    continue
+                seconds = sum(record['stages_s'].values())
+                self.file_seconds[record['source_path']] = seconds
+                feed_totals = totals.setdefault(record['feed'], [0, 0.0, 0, 0])
+                feed_totals[0] += record['bytes_in']
+                feed_totals[1] += seconds
+                feed_totals[2] += record.get('csv_bytes') or 0
+                feed_totals[3] += record.get('rows_in') or 0
+        for feed, (bytes_in, seconds, csv_bytes, rows_in) in totals.items():
+            self.seconds_per_byte[feed] = seconds / bytes_in
+            if csv_bytes:
+                self.expansion[feed] = csv_bytes / bytes_in
+                if rows_in:
+                    self.csv_bytes_per_row[feed] = csv_bytes / rows_in
+        logging.info(f'Cost model from {len(self.file_seconds)} loaded files: '
+                     f'{ {x: round(y * MB, 3) for x, y in self.seconds_per_byte.items()} } s/MB')
+    
+    def cost(self, feed, source_path, size):
+        if source_path in self.file_seconds:
+            return self.file_seconds[source_path]
+        return size * self.seconds_per_byte.get(feed, DEFAULT_SECONDS_PER_MB / MB)
+    
+    def memory(self, feed, size):
+        # Q memory the file needs while it is loaded, chunked feeds only ever hold one block
+        schema = FEEDS[feed]
+        csv_bytes = size * self.expansion.get(feed, DEFAULT_EXPANSION)
+        if schema.chunk_rows is not None:
+            csv_bytes = min(csv_bytes, schema.chunk_rows * self.csv_bytes_per_row.get(feed, DEFAULT_CSV_BYTES_PER_ROW))
+        return int(csv_bytes * Q_MEMORY_PER_CSV_BYTE)
+    
+    def work_items(self, work_units, source_index=None):
+        items, sizes = [], {}
+        for feed, data_path, zipped_filename in work_units:
+            if data_path not in sizes:
+                sizes[data_path] = source_file_sizes(source_index, data_path)
+            full_input_filename = os.path.join(data_path, zipped_filename).replace("\\", "/")
+            size = sizes[data_path][zipped_filename] if zipped_filename in sizes[data_path] else os.path.getsize(full_input_filename)
+            items.append(WorkItem((feed, data_path, zipped_filename), self.cost(feed, full_input_filename, size), self.memory(feed, size)))
+        return items
+
+
+def source_file_sizes(source_index, data_path):
+    # file name => size, as the directory listing of the source index has them (no stat per file)
+    if source_index is None:
+        return {}
+    return {x.name: x.size for x in source_index.directory(data_path).source_files}
+
+
+class WorkStealingScheduler:
+    def __init__(self, items, n_workers, worker_memory=None, memory_budget=None):
+        # worker_memory: bytes of Q memory per worker (a number for all of them or one per worker), None for no limit; memory_budget:
+        # bytes the files running at the same time may take together
+        self.n_workers = n_workers
+        self.worker_memory = list(worker_memory) if isinstance(worker_memory, (list, tuple)) else [worker_memory] * n_workers
+        self.memory_budget = memory_budget
+        self.condition = threading.Condition()
+        self.running_memory = 0
+        self.n_running = 0
+        self.queues = [deque() for _ in range(n_workers)]  # largest file first
+        self.loads = [0.0] * n_workers  # estimated seconds left on each worker
+        self.n_stolen = 0
+        self.assign(sorted(items, key=lambda x: x.cost, reverse=True))
+    
+    def fits_worker(self, worker, item):
+        return self.worker_memory[worker] is None or item.memory <= self.worker_memory[worker]
+    
+    def assign(self, items):
+        # LPT: each file goes to the worker with the least work so far among those it fits on (the largest worker if it fits nowhere)
+        largest_worker = max(range(self.n_workers), key=lambda x: float('inf') if self.worker_memory[x] is None else self.worker_memory[x])
+        for item in items:
+            candidates = [x for x in range(self.n_workers) if self.fits_worker(x, item)]
+            if not candidates:
+                logging.warning(f'{item.unit} needs about {item.memory // MB} MB, more than any worker has, it goes to worker {largest_worker}')
+                candidates = [largest_worker]
+            worker = min(candidates, key=lambda x: self.loads[x])
+            self.queues[worker].append(item)
+            self.loads[worker] += item.cost
+        logging.info(f'Scheduled {len(items)} files, estimated seconds per worker: {[round(x) for x in self.loads]}')
+    
+    def fits_budget(self, item):
+        # a file always runs when nothing else does, or a file larger than the budget would never start
+        return self.memory_budget is None or self.n_running == 0 or self.running_memory + item.memory <= self.memory_budget
+    
+    def take(self, worker):
+        # the next item for the worker: its own largest that fits, else the smallest that fits from the most loaded other worker
+        for item in self.queues[worker]:
+            if self.fits_budget(item):
+                self.queues[worker].remove(item)
+                self.loads[worker] -= item.cost
+                return item
+        for victim in sorted((x for x in range(self.n_workers) if x != worker), key=lambda x: self.loads[x], reverse=True):
+            for item in reversed(self.queues[victim]):
+                if self.fits_worker(worker, item) and self.fits_budget(item):
+                    self.queues[victim].remove(item)
+                    self.loads[victim] -= item.cost
+                    self.n_stolen += 1
+                    return item
+        return None
+    
+    def next_item(self, worker):
+        # blocks while the files that are left wait for memory, returns None once there is nothing left for this worker
+        with self.condition:
+            while True:
+                item = self.take(worker)
+                if item is not None:
+                    self.running_memory += item.memory
+                    self.n_running += 1
+                    return item
+                if not self.queues[worker] and not any(self.fits_worker(worker, x) for queue in self.queues for x in queue):
+                    return None
+                self.condition.wait()
+    
+    def done(self, item):
+        with self.condition:
+            self.running_memory -= item.memory
+            self.n_running -= 1
+            self.condition.notify_all()
@@ -1,23 +1,65 @@
 import os
-import pandas as pd
 import re
 import gzip
+import argparse
 import shutil
 from datetime import datetime
-from qpython import qconnection
 import logging
+import threading
+from functools import partial
+from itertools import groupby
+from collections import namedtuple
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from feeds import FEEDS, SYM_SOURCE_COLUMN, Q_SUM_STATS, q_parse, q_csv_lines, q_transform, q_table_stats
+from manifest import IngestManifest, reset_partition, table_stats, NEW, COMPLETE
+from metrics import FileMetrics, MetricsRecorder, q_memory, partition_size
+from prefetch import prefetch_in_order, read_gz_blocks, split_line_chunks, gzip_uncompressed_size
+from file_index import SourceIndex
 
-SRC_DATA_DIR = 'D:/data/m_data/EUX/'  # where the original files live
-TRADES_DIR = "I:/beetroot/trades/"  # where KDB trades will live  # "I:/testkdb/trades/" #
-ORDERS_DIR = "I:/beetroot/orders/"  # where KDB orders will live "I:/testkdb/books/"  #
-BOOKS_DIR = "I:/beetroot/books/"  # where KDB books will live "I:/testkdb/books/"  #
+# importing this module only defines things (worker processes import it and should start fast): pandas, numpy and qpython are imported
+# where they are used, logging is set up by the entry points (setup_logging) and the paths below are only touched once a load runs
+
+SRC_ROOT_DIR = 'D:/data/m_data/'  # where the original files live, one sub directory per venue (EUX, ETF, MTA)
+KDB_ROOT_DIR = "I:/beetroot/"  # where the KDB databases will live, one sub directory per feed (trades, orders, books)  # "I:/testkdb/" #
 EXTRACT_DIR = "I:/beetroot/csv_data_from_py"  # where we temporarily extract files and delete them after processing
 LOG_DIR = "D:/data/logs/"  # where we write the logs of the process
+MANIFEST_FILE = "I:/beetroot/ingest_manifest.db"  # record of every source file loaded so far, reruns skip what is already complete
+METRICS_FILE = "D:/data/logs/ingest_metrics.jsonl"  # per file timings, sizes, row counts and Q memory, one json line per file
+SOURCE_INDEX_FILE = "I:/beetroot/source_index.json"  # listings of the source directories, rescanned only when a directory changed
 Q_PORT_NUMBER = 40000  # port number where you started a multithreaded Q (q -p 40000 -s 12)
+START_DATE = '2017-05-01'  # first day (YYYY-MM-DD) a run loads unless the command line narrows it down
+END_DATE = '2019-02-28'  # last day (YYYY-MM-DD, inclusive)
+STREAM_INGEST = True  # decompress the .gz in python and push the rows to Q over IPC instead of copying/extracting to EXTRACT_DIR
+STREAM_CHUNK_LINES = 250000  # csv lines sent to Q per IPC message when streaming (at least, the decompressed blocks are cut at whole lines)
+PARSE_ENGINE = 'q'  # 'q' parses and cleans the csv inside Q, 'python' does it with pandas/numpy (py_engine.py) and pushes ready columns
+PARQUET_ROOT_DIR = None  # python engine only: also write the tables as date partitioned parquet here (parquet_sink.py), None switches it off
+PREFETCH_FILES = 2  # files decompressed (or copied/extracted) in background threads while Q ingests the current one, 0 switches it off
+PREFETCH_BUDGET_BYTES = 2 * 1024 ** 3  # cap on prefetched data waiting for Q: memory when streaming, EXTRACT_DIR space when extracting
+DECOMPRESS_THREADS = 4  # threads inflating the blocks of multi-member (BGZF) archives in parallel
+VALIDATE_AFTER_LOAD = True  # check the partitions written by the run against what was loaded into them (validate_hdb.py)
+WHOLE_DAY_WRITES = False  # Q engine: write each date partition once from all of its files, staged next to the HDB and swapped in (process_feed_day)
+DEDUP_ROWS = False  # whole day writes only: drop rows repeated across (or within) the files of a day, see FeedSchema.dedup_columns
+STAGING_SUFFIX = '_staging'  # whole day writes put the partition together in <kdb dir><suffix>/<date>/<table> before swapping it in
+FILE_RETRIES = 2  # times a file is loaded again when the connection to Q dropped (and was reopened) before its partition was written
+
+HDB_WRITE_LOCKS = {}  # one lock per HDB root, .Q.dpft appends to the partition and the sym file so writers to the same root take turns
+HDB_WRITE_LOCKS_GUARD = threading.Lock()
+PARTITION_WRITE_LOCKS = {}  # one lock per (HDB root, date), a chunked file appends its blocks and puts p# back without other writers
+
+# the source files a run loads: start_date/end_date YYYY-MM-DD (inclusive), instruments the instrument ids of the file names and isins
+# the ISINs in the files (None for all of them), reload writes the selected dates again even if the manifest has them complete
+FileSelection = namedtuple('FileSelection', ['start_date', 'end_date', 'instruments', 'isins', 'reload'],
+                           defaults=[START_DATE, END_DATE, None, None, False])
+
 
-logging.basicConfig(filename=os.path.join(LOG_DIR, f"upload_kdb_main_{datetime.now().strftime('%Y%m%dT%H%M%S')}.log").replace("\\", "/"),
-                    filemode='a',
-                    level=logging.DEBUG)
+def setup_logging(log_prefix='upload_kdb_main', log_dir=None):
+    log_dir = LOG_DIR if log_dir is None else log_dir
+    os.makedirs(log_dir, exist_ok=True)
+    logging.basicConfig(filename=os.path.join(log_dir, f"{log_prefix}_{datetime.now().strftime('%Y%m%dT%H%M%S')}.log").replace("\\", "/"),
+                        filemode='a',
+                        format='%(levelname)s:%(asctime)s:%(threadName)s:%(message)s',
+                        level=logging.DEBUG)
 
 
 # Our license does not allow us to start a v4 Q process remotely so this will be for later...
@@ -47,130 +89,694 @@ def clean_up_files(copied_original, extracted_file, full_output_filename):
             logging.info(f'Deleted {full_output_filename}')
 
 
+def hdb_write_lock(kdb_dir):
+    with HDB_WRITE_LOCKS_GUARD:
+        return HDB_WRITE_LOCKS.setdefault(os.path.normpath(kdb_dir), threading.RLock())
+
+
+def partition_write_lock(kdb_dir, date_string):
+    with HDB_WRITE_LOCKS_GUARD:
+        return PARTITION_WRITE_LOCKS.setdefault((os.path.normpath(kdb_dir), date_string), threading.RLock())
+
+
+def write_partition(q, kdb_dir, date_string, table_name, partition_by='sym'):
+    # returns the table_stats (rows, time range, column checksums) of what was written, for validate_hdb.py
+    with hdb_write_lock(kdb_dir):
+        # should be OK to delete because of single threaded execution ??? check
+        return table_stats(q(f'{{s:{q_table_stats(table_name)}; .Q.dpft[`:{kdb_dir};{date_string};`{partition_by};`{table_name}]; '
+                             f'delete {table_name} from `.; s}}[]'))
+
+
+def partition_table_dir(kdb_dir, date_string, table_name):
+    return os.path.join(kdb_dir, date_string, table_name).replace("\\", "/") + "/"
+
+
+def staging_table_dir(kdb_dir, date_string, table_name):
+    # next to the HDB rather than inside it (Q would take the directory for a table), on the same disk so swapping it in is a rename
+    return partition_table_dir(kdb_dir.rstrip("/") + STAGING_SUFFIX, date_string, table_name)
+
+
+def q_append_to_partition(kdb_dir, date_string, table_name, table, table_dir=None):
+    # Q statement appending the in-memory table `table`, already enumerated against the HDB, to the splayed table of the date partition
+    # (or table_dir), and keeping the stats of each block in .ingest.stats (emptied before the first block of a file)
+    table_dir = partition_table_dir(kdb_dir, date_string, table_name) if table_dir is None else table_dir
+    return f'`:{table_dir} upsert {table}; .ingest.stats,:enlist {q_table_stats(table)}'
+
+
+def append_block(q, kdb_dir, date_string, table_name, table_dir=None):
+    # appends the block parsed into .ingest.block to the date partition (or table_dir): the sym file is shared by all the dates of the HDB,
+    # so only the enumeration takes the HDB lock; the caller holds the lock of the partition (partition_write_lock) for all of a file's blocks
+    with hdb_write_lock(kdb_dir):
+        q(f'.ingest.block:.Q.en[`:{kdb_dir}] .ingest.block')
+    q(f'{q_append_to_partition(kdb_dir, date_string, table_name, ".ingest.block", table_dir)}; delete block from `.ingest')
+
+
+def sort_partition(q, kdb_dir, date_string, table_name, partition_by='sym', table_dir=None):
+    # what .Q.dpft does to the table before writing it, done to the partition on disk once all its blocks were appended: xasc sorts a
+    # splayed table one column at a time, so Q only ever holds a column of the partition; returns the table_stats of the blocks appended
+    # for the file
+    table_dir = partition_table_dir(kdb_dir, date_string, table_name) if table_dir is None else table_dir
+    with hdb_write_lock(kdb_dir):
+        return table_stats(q(f'{{`{partition_by} xasc x; @[x;`{partition_by};`p#]; {Q_SUM_STATS}[.ingest.stats]}}`:{table_dir}'))
+
+
+def index_partition(q, kdb_dir, date_string, table_name, partition_by='sym', table_dir=None):
+    # done to the partition once the blocks of a chunked file were appended: a source file holds one sym, so its rows already follow each
+    # other and only p# has to be put back (which rewrites just that column, not the partition); a partition whose syms are not in runs
+    # (a file with several instruments) is sorted as sort_partition does; returns the table_stats of the blocks appended for the file
+    # the files come in file name (instrument id) order, not in sym order: sort_chunked_partition sorts the date once its last file is in
+    table_dir = partition_table_dir(kdb_dir, date_string, table_name) if table_dir is None else table_dir
+    with partition_write_lock(kdb_dir, date_string):
+        return table_stats(q(f'{{@[{{@[x;`{partition_by};`p#]}};x;{{[d;e] `{partition_by} xasc d; @[d;`{partition_by};`p#]}}[x]]; '
+                             f'{Q_SUM_STATS}[.ingest.stats]}}`:{table_dir}'))
+
+
+def sort_chunked_partition(q, kdb_dir, date_string, table_name, partition_by='sym'):
+    # after the last chunked file of a date: the partition sorted on partition_by with p#, as .Q.dpft leaves it, once per date instead
+    # of once per file; the runs of the syms are only compared, a partition already in order is not rewritten
+    table_dir = partition_table_dir(kdb_dir, date_string, table_name)
+    if not os.path.isdir(table_dir):
+        return
+    with partition_write_lock(kdb_dir, date_string):
+        q(f'{{if[not s~asc s:distinct get[x]`{partition_by}; `{partition_by} xasc x; @[x;`{partition_by};`p#]]}}`:{table_dir}')
+
+
+def q_add_to_day(table_name):
+    # moves the table of the file just loaded into .ingest.day, where the files of the date are gathered; returns its row count
+    return f'{{n:count {table_name}; .ingest.day:$[98h=type .ingest.day; .ingest.day,{table_name}; {table_name}]; delete {table_name} from `.; n}}[]'
+
+
+def write_staged_partition(q, kdb_dir, date_string, table_name, partition_by='sym', dedup_columns=None, dedup=False):
+    # what .Q.dpft does, for .ingest.day into the staging directory: enumerate against the sym file of the HDB, sort, p#; dedup keeps the
+    # first of the rows equal on dedup_columns (whole rows if None); returns the table_stats of the staged partition
+    staged_dir = staging_table_dir(kdb_dir, date_string, table_name)
+    day = '.ingest.day'
+    if dedup:
+        day = 'distinct .ingest.day' if dedup_columns is None else f'select from .ingest.day where i=(first;i) fby ([]{";".join(dedup_columns)})'
+    with hdb_write_lock(kdb_dir):
+        return table_stats(q(f'{{t:{day}; s:{q_table_stats("t")}; `:{staged_dir} set .Q.en[`:{kdb_dir}] `{partition_by} xasc t; '
+                             f'@[`:{staged_dir};`{partition_by};`p#]; delete day from `.ingest; s}}[]'))
+
+
+def clear_staging(kdb_dir, date_string, table_name):
+    # leftovers of an interrupted whole day write: a partition retired by an unfinished swap goes back in place, a staged one is dropped
+    staged_dir = staging_table_dir(kdb_dir, date_string, table_name).rstrip("/")
+    live_dir = partition_table_dir(kdb_dir, date_string, table_name).rstrip("/")
+    if os.path.isdir(staged_dir + '.old'):
+        if not os.path.isdir(live_dir):
+            os.replace(staged_dir + '.old', live_dir)
+        else:
+            shutil.rmtree(staged_dir + '.old')
+    if os.path.isdir(staged_dir):
+        shutil.rmtree(staged_dir)
+
+
+def swap_in_partition(kdb_dir, date_string, table_name):
+    # the staged partition replaces the live one: two renames on the same disk, readers see either the old or the new partition (or,
+    # on Windows, none for the instant between the renames)
+    staged_dir = staging_table_dir(kdb_dir, date_string, table_name).rstrip("/")
+    live_dir = partition_table_dir(kdb_dir, date_string, table_name).rstrip("/")
+    with hdb_write_lock(kdb_dir):
+        os.makedirs(os.path.dirname(live_dir), exist_ok=True)
+        if os.path.isdir(live_dir):
+            os.replace(live_dir, staged_dir + '.old')
+        os.replace(staged_dir, live_dir)
+        if os.path.isdir(staged_dir + '.old'):
+            shutil.rmtree(staged_dir + '.old')
+    logging.info(f'Swapped in partition {live_dir}')
+
+
 def date_string_from_file_name(filename):
     return datetime.strptime(os.path.basename(filename).split("_")[0], '%Y%m%d').strftime("%Y.%m.%d")
 
 
-def copy_and_extract(zipped_trade_filename, parent_dir, temp_dir):
+def copy_source_file(full_input_filename, full_output_filename):
+    logging.info(f"Copying {full_input_filename} to {full_output_filename}")
+    shutil.copyfile(full_input_filename, full_output_filename)
+    return os.path.isfile(full_output_filename)
+
+
+def extract_gz_file(full_output_filename, extracted_file):
+    logging.info(f"Unzipping {full_output_filename}")
+    with gzip.open(full_output_filename, 'rb') as f_in:
+        with open(extracted_file, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+    return os.path.isfile(extracted_file)
+
+
+def copy_and_extract(zipped_trade_filename, parent_dir, temp_dir, file_metrics=None):
     full_input_filename = zipped_trade_filename if parent_dir is None else os.path.join(parent_dir, zipped_trade_filename).replace("\\", "/")
+    file_metrics = FileMetrics(None, full_input_filename) if file_metrics is None else file_metrics
     # if no output dir is specified, file will be extracted in place
     full_output_filename = None if temp_dir is None else os.path.join(temp_dir, zipped_trade_filename).replace("\\", "/")
     copied_original = False
     if full_output_filename is not None:
-        logging.info(f"Copying {full_input_filename} to {full_output_filename}")
-        shutil.copyfile(full_input_filename, full_output_filename)
-        copied_original = os.path.isfile(full_output_filename)
+        with file_metrics.stage('copy'):
+            copied_original = copy_source_file(full_input_filename, full_output_filename)
     else:
         full_output_filename = full_input_filename
-    logging.info(f"Unzipping {full_output_filename}")
     extracted_file = full_output_filename.replace(".gz", "")
-    with gzip.open(full_output_filename, 'rb') as f_in:
-        with open(extracted_file, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-    extraction_ok = os.path.isfile(extracted_file)
+    with file_metrics.stage('extract'):
+        extraction_ok = extract_gz_file(full_output_filename, extracted_file)
     if not extraction_ok:
         logging.error(f'Failed to find extracted file {extracted_file}')
+    else:
+        file_metrics.csv_bytes += os.path.getsize(extracted_file)
     
     return full_input_filename, full_output_filename, extracted_file, copied_original, extraction_ok
 
 
-def process_order_file(q, zipped_book_filename, kdb_dir=ORDERS_DIR, parent_dir=None, temp_dir=None):
-    full_input_filename, full_output_filename, extracted_file, copied_original, extraction_ok = copy_and_extract(zipped_book_filename, parent_dir, temp_dir)
-    if not extraction_ok:
-        return False
-    
-    date_string = date_string_from_file_name(extracted_file)
-    logging.info(f"Processing {extracted_file}")
-    
-    q(f'orders:("SDIIIFIFIIISFFF";enlist "|") 0: `:{extracted_file};')
-    q('update sym:ISIN, time: (1000*TimeMM) + Date + `second$(60*60*TimeSec div 10000) + (60 * (TimeSec mod 10000) div 100) + (TimeSec mod 100) from `orders;')
-    q('delete from `orders where Qty=0; delete ISIN, TimeMM, Date, TimeSec, MarketTime, MarketTimeMM from `orders;')
-    q(f'orders:`sym`time xcols orders;')
-    q(f'.Q.dpft[`:{kdb_dir};{date_string};`sym;`orders];')
-    q(f'delete orders from `.;')  # should be OK because of single threaded execution ??? check
-    
-    clean_up_files(copied_original, extracted_file, full_output_filename)
+def read_gz_line_chunks(full_input_filename, chunk_lines=STREAM_CHUNK_LINES):
+    # yields (header line, text of the next chunk_lines data lines, lines in it), decompressing as we go (nothing touches the disk)
+    return split_line_chunks(read_gz_blocks(full_input_filename), chunk_lines)
 
 
-def process_book_file(q, zipped_book_filename, kdb_dir=BOOKS_DIR, parent_dir=None, temp_dir=None):
-    full_input_filename, full_output_filename, extracted_file, copied_original, extraction_ok = copy_and_extract(zipped_book_filename, parent_dir, temp_dir)
-    if not extraction_ok:
-        return False
-    
-    date_string = date_string_from_file_name(extracted_file)
-    logging.info(f"Processing {extracted_file}")
-    
-    q(f'books:("SDIIFFFFFFFFFFFFFFFFFFFF";enlist "|") 0: `:{extracted_file};')
-    q('update sym:ISIN, time: (1000*TimeMM) + Date + `second$(60*60*TimeSec div 10000) + (60 * (TimeSec mod 10000) div 100) + (TimeSec mod 100) from `books;')
-    q('delete from `books where Bid_Px_Lev_0<=0;delete ISIN, TimeMM, Date, TimeSec, MarketTime from `books;')
-    q(f'books:`sym`time xcols books;')
-    q(f'.Q.dpft[`:{kdb_dir};{date_string};`sym;`books];')
-    q(f'delete books from `.;')  # should be OK because of single threaded execution ??? check
-    
-    clean_up_files(copied_original, extracted_file, full_output_filename)
+def stream_gz_to_q(q, schema, full_input_filename, chunk_lines=STREAM_CHUNK_LINES, chunks=None, file_metrics=None):
+    # every chunk goes out as one char vector (with the header line as another) and is split into lines, parsed, filtered and transformed
+    # by Q in one go and appended in place to the global table; the chunks go out async, so we decompress the next one while Q parses,
+    # and their errors surface with the sync of the partition write
+    # prefetched chunks were timed by the thread that decompressed them, so here we only time our own decompression
+    file_metrics = FileMetrics(schema.name, full_input_filename) if file_metrics is None else file_metrics
+    if chunks is None:
+        chunks = file_metrics.timed_items('extract', read_gz_line_chunks(full_input_filename, chunk_lines))
+    n_chunks = 0
+    lines = q_parse(schema, q_csv_lines('h', 'x'))
+    for header, text, n_lines in chunks:
+        file_metrics.rows_in += n_lines
+        file_metrics.csv_bytes += len(text)
+        with file_metrics.stage('parse'):
+            if n_chunks == 0:
+                q.send_async(f'{{[h;x] {schema.table}::{q_transform(schema, lines)}}}', header, text)
+            else:
+                q.send_async(f'{{[h;x] `{schema.table} upsert {q_transform(schema, lines)}}}', header, text)
+        n_chunks += 1
+    if n_chunks == 0:
+        logging.warning(f'No data found in {full_input_filename}, it is loaded with 0 rows')
+        return True
+    # wait for Q to get through the chunks, a dropped connection or a failed chunk shows up here while the file can still be loaded again
+    with file_metrics.stage('parse'):
+        q.sync('::')
+    return True
+
 
+def stream_gz_to_partition(q, schema, full_input_filename, kdb_dir, chunks=None, file_metrics=None, table_dir=None, held=None):
+    # like stream_gz_to_q, but each block of schema.chunk_rows lines goes straight to the date partition on disk (or table_dir) instead of
+    # into the global table, returns the date string of the file or None; each block is parsed before any lock is taken, the lock of the
+    # partition is entered into held (an ExitStack of the caller) with the first append and kept until the partition has its p# again
+    # (index_partition), so the blocks of the file are one run in the partition
+    file_metrics = FileMetrics(schema.name, full_input_filename) if file_metrics is None else file_metrics
+    if chunks is None:
+        chunks = file_metrics.timed_items('extract', read_gz_line_chunks(full_input_filename, schema.chunk_rows))
+    date_string = date_string_from_file_name(full_input_filename)
+    q.send_async('.ingest.stats:()')
+    n_chunks = 0
+    lines = q_parse(schema, q_csv_lines('h', 'x'))
+    for header, text, n_lines in chunks:
+        file_metrics.rows_in += n_lines
+        file_metrics.csv_bytes += len(text)
+        with file_metrics.stage('parse'):
+            q(f'{{[h;x] .ingest.block:{q_transform(schema, lines)}; }}', header, text)
+        if held is not None and n_chunks == 0:
+            held.enter_context(partition_write_lock(kdb_dir, date_string))
+        with file_metrics.stage('write'):
+            append_block(q, kdb_dir, date_string, schema.table, table_dir)
+        n_chunks += 1
+    if n_chunks == 0:
+        logging.warning(f'No data found in {full_input_filename}, it is loaded with 0 rows')
+    return date_string
 
-def process_trade_file(q, zipped_trade_filename, kdb_dir=TRADES_DIR, parent_dir=None, temp_dir=None):
-    full_input_filename, full_output_filename, extracted_file, copied_original, extraction_ok = copy_and_extract(zipped_trade_filename, parent_dir, temp_dir)
+
+def load_into_q(q, schema, zipped_filename, parent_dir=None, temp_dir=None, stream=STREAM_INGEST, prefetched=None, file_metrics=None):
+    # loads the csv inside zipped_filename into the global Q table of the feed, ready to be written, returns the date string of the file or None;
+    # a file without data rows (file_metrics.rows_in 0) leaves the global table as it was, there is nothing of it to write
+    # prefetched: what the prefetch pipeline prepared for this file (the line chunks when streaming, the copy_and_extract result if not)
+    if stream:
+        full_input_filename = zipped_filename if parent_dir is None else os.path.join(parent_dir, zipped_filename).replace("\\", "/")
+        logging.info(f"Streaming {full_input_filename}")
+        if not stream_gz_to_q(q, schema, full_input_filename, chunks=prefetched, file_metrics=file_metrics):
+            return None
+        return date_string_from_file_name(full_input_filename)
+    
+    extraction = copy_and_extract(zipped_filename, parent_dir, temp_dir, file_metrics) if prefetched is None else next(iter(prefetched))
+    full_input_filename, full_output_filename, extracted_file, copied_original, extraction_ok = extraction
     if not extraction_ok:
-        return False
+        return None
     
-    date_string = date_string_from_file_name(extracted_file)
     logging.info(f"Processing {extracted_file}")
-    q(f'trades:("SDIIIIFI";enlist "|") 0: `:{extracted_file};')
-    q('update sym:ISIN, time: (1000*TimeMM) + Date + `second$(60*60*TimeSec div 10000) + (60 * (TimeSec mod 10000) div 100) + (TimeSec mod 100) from `trades;')
-    q('delete from `trades where Price=0;delete ISIN, TimeMM, Date, TimeSec, MarketTime from `trades;')
-    q(f'trades:`sym`time`Price`Qty`Volume xcols trades;')
-    q(f'.Q.dpft[`:{kdb_dir};{date_string};`sym;`trades];')
-    q(f'delete trades from `.;')  # should be OK because of single threaded execution ??? check
-    
-    clean_up_files(copied_original, extracted_file, full_output_filename)
+    with file_metrics.stage('parse'):
+        rows_in = q(f'{{raw:{q_parse(schema, "`:" + extracted_file)}; {schema.table}::{q_transform(schema, "raw")}; count raw}}[]')
+    file_metrics.rows_in += 0 if rows_in is None else int(rows_in)
+    # Q holds the table in memory now, so the copies are no longer needed
+    with file_metrics.stage('cleanup'):
+        clean_up_files(copied_original, extracted_file, full_output_filename)
+    return date_string_from_file_name(extracted_file)
+
+
+def load_with_retries(q, schema, zipped_filename, kdb_dir, parent_dir=None, temp_dir=None, stream=STREAM_INGEST, prefetched=None, file_metrics=None,
+                      table_dir=None, held=None):
+    # loads the file into Q (or the blocks of a chunked file into its partition or table_dir), returns the date string of the file or None;
+    # when the connection drops it is reopened and the file loaded again from its source, unless blocks of it may already be on disk
+    full_input_filename = zipped_filename if parent_dir is None else os.path.join(parent_dir, zipped_filename).replace("\\", "/")
+    from qconn import QConnectionLost
+    file_metrics = FileMetrics(schema.name, full_input_filename) if file_metrics is None else file_metrics
+    for attempt in range(FILE_RETRIES + 1):
+        q.ensure_connected()
+        try:
+            if schema.chunk_rows is not None:
+                logging.info(f"Appending {full_input_filename} to {kdb_dir} in blocks of {schema.chunk_rows} rows")
+                return stream_gz_to_partition(q, schema, full_input_filename, kdb_dir, prefetched, file_metrics, table_dir, held)
+            return load_into_q(q, schema, zipped_filename, parent_dir, temp_dir, stream, prefetched, file_metrics)
+        except QConnectionLost:
+            if schema.chunk_rows is not None or attempt == FILE_RETRIES:
+                raise
+            logging.warning(f'Loading {full_input_filename} again, the connection to Q was lost (attempt {attempt + 1} of {FILE_RETRIES})')
+            file_metrics.restart()
+            prefetched = None  # partly consumed, we read the source again
+
+
+def process_feed_file(q, feed, zipped_filename, kdb_dir=None, parent_dir=None, temp_dir=None, stream=STREAM_INGEST, manifest=None, prefetched=None,
+                      metrics=None, file_metrics=None):
+    schema = FEEDS[feed]
+    kdb_dir = feed_kdb_dir(feed) if kdb_dir is None else kdb_dir
+    full_input_filename = zipped_filename if parent_dir is None else os.path.join(parent_dir, zipped_filename).replace("\\", "/")
+    file_metrics = FileMetrics(feed, full_input_filename, file_load_mode(schema, stream)) if file_metrics is None else file_metrics
+    file_metrics.start()
+    if manifest is not None:
+        manifest.mark_started(full_input_filename, kdb_dir, feed, date_string_from_file_name(zipped_filename))
+    # an exception leaves the file 'started' in the manifest, the next run then rewrites its partition
+    try:
+        # a chunked file writes to its partition with every block, from its first append until the partition has its p# again it holds
+        # the partition's lock (held), files of other dates go on in parallel
+        with ExitStack() as held:
+            date_string = load_with_retries(q, schema, zipped_filename, kdb_dir, parent_dir, temp_dir, stream, prefetched, file_metrics, held=held)
+            stats = None
+            if date_string is not None and file_metrics.rows_in == 0:
+                stats = {'rows': 0, 'min_time': None, 'max_time': None, 'checksums': {}}  # a file without data is complete with 0 rows
+            elif date_string is not None:
+                with file_metrics.stage('write'):
+                    if schema.chunk_rows is not None:
+                        stats = index_partition(q, kdb_dir, date_string, schema.table, schema.partition_by)
+                    else:
+                        stats = write_partition(q, kdb_dir, date_string, schema.table, schema.partition_by)
+        row_count = None if stats is None else stats['rows']
+        if date_string is not None:
+            file_metrics.date, file_metrics.rows_out = date_string, row_count
+            if metrics is not None:
+                file_metrics.bytes_out = partition_size(kdb_dir, date_string, schema.table)
+                file_metrics.q_memory = q_memory(q)
+        file_metrics.finish('failed' if date_string is None else COMPLETE)
+    except Exception:
+        file_metrics.finish('error')
+        raise
+    finally:
+        if metrics is not None:
+            metrics.record(file_metrics)
+    if manifest is not None:
+        if date_string is None:
+            manifest.mark_failed(full_input_filename, kdb_dir, feed, date_string_from_file_name(zipped_filename))
+        else:
+            manifest.mark_complete(full_input_filename, kdb_dir, feed, date_string, row_count, stats)
+    return date_string is not None
+
+
+def process_feed_day(q, feed, date_string, day_files, kdb_dir=None, parent_dir=None, temp_dir=None, stream=STREAM_INGEST, manifest=None, metrics=None,
+                     dedup=DEDUP_ROWS):
+    # whole day writes: all the files of the date (day_files: (zipped filename, prefetched or None, FileMetrics or None)) are gathered in Q
+    # (chunked feeds: appended to the staging directory), written once to the staging directory and swapped in for the live partition,
+    # so a date loaded again replaces its partition instead of adding to it; the first file of the date carries the row count and stats
+    # of the partition in the manifest, the others none; returns True if a partition was swapped in
+    schema = FEEDS[feed]
+    kdb_dir = feed_kdb_dir(feed) if kdb_dir is None else kdb_dir
+    staged_dir = staging_table_dir(kdb_dir, date_string, schema.table)
+    clear_staging(kdb_dir, date_string, schema.table)
+    started, loaded = [], []  # (full input filename, FileMetrics) of the files we started and of those that made it into Q
+    stats = None
+    try:
+        # the staging directory is ours alone, the blocks of chunked files only take the HDB lock to enumerate (append_block)
+        q.send_async('.ingest.day:()')
+        for zipped_filename, prefetched, file_metrics in day_files:
+            full_input_filename = zipped_filename if parent_dir is None else os.path.join(parent_dir, zipped_filename).replace("\\", "/")
+            if file_metrics is None:
+                file_metrics = FileMetrics(feed, full_input_filename, file_load_mode(schema, stream))
+            file_metrics.start()
+            started.append((full_input_filename, file_metrics))
+            if manifest is not None:
+                manifest.mark_started(full_input_filename, kdb_dir, feed, date_string)
+            if load_with_retries(q, schema, zipped_filename, kdb_dir, parent_dir, temp_dir, stream, prefetched, file_metrics,
+                                 staged_dir if schema.chunk_rows is not None else None) is None:
+                file_metrics.finish('failed')
+                continue
+            if file_metrics.rows_in == 0:
+                file_metrics.date, file_metrics.rows_out = date_string, 0
+                file_metrics.finish(COMPLETE)  # nothing of it to write, complete with 0 rows
+                continue
+            if schema.chunk_rows is None:
+                rows = q(q_add_to_day(schema.table))
+                file_metrics.rows_out = None if rows is None else int(rows)
+            loaded.append((full_input_filename, file_metrics))
+        if loaded:
+            with loaded[0][1].stage('write'):
+                if schema.chunk_rows is not None:
+                    if dedup:
+                        logging.warning(f'Not deduplicating {feed} {date_string}, chunked feeds are never held in memory as a whole')
+                    sort_partition(q, kdb_dir, date_string, schema.table, schema.partition_by, staged_dir)
+                    stats = table_stats(q(f'{{{q_table_stats("get x")}}}`:{staged_dir}'))
+                else:
+                    stats = write_staged_partition(q, kdb_dir, date_string, schema.table, schema.partition_by, schema.dedup_columns, dedup)
+                swap_in_partition(kdb_dir, date_string, schema.table)
+            if stats is not None and dedup and schema.chunk_rows is None:
+                logging.info(f"Wrote {stats['rows']} rows of {feed} {date_string} after dropping "
+                             f"{sum(x.rows_out or 0 for _, x in loaded) - stats['rows']} duplicates")
+            if metrics is not None:
+                loaded[0][1].bytes_out = partition_size(kdb_dir, date_string, schema.table)
+                loaded[0][1].q_memory = q_memory(q)
+        for _, file_metrics in loaded:
+            file_metrics.date = date_string
+            file_metrics.finish(COMPLETE)
+    except Exception:
+        for _, file_metrics in started:
+            if file_metrics.status is None:
+                file_metrics.finish('error')
+        raise
+    finally:
+        if metrics is not None:
+            for _, file_metrics in started:
+                metrics.record(file_metrics)
+    if manifest is not None:
+        for full_input_filename, file_metrics in started:
+            if file_metrics.status != COMPLETE:
+                manifest.mark_failed(full_input_filename, kdb_dir, feed, date_string)
+            elif loaded and full_input_filename == loaded[0][0]:
+                manifest.mark_complete(full_input_filename, kdb_dir, feed, date_string, None if stats is None else stats['rows'], stats)
+            else:
+                manifest.mark_complete(full_input_filename, kdb_dir, feed, date_string, 0,
+                                       None if loaded and stats is None else {'rows': 0, 'min_time': None, 'max_time': None, 'checksums': {}})
+    return bool(loaded)
+
+
+def plan_feed_files(manifest, feed, data_path, zipped_filenames, kdb_dir, whole_days=False, selected=None, reload=False):
+    # returns the files that still have to be loaded; a date with a changed or half loaded file gets its partition removed and all
+    # of its files reloaded, since .Q.dpft appends and we cannot take back the rows of just one file; with whole_days a date with
+    # anything new is loaded again from all of its files, its partition stays readable until the rewritten one is swapped in
+    # selected: the files asked for (select_feed_files), zipped_filenames then holds all the files of their dates, as a date that is
+    # written again needs all of them; reload writes the dates of the selected files again even if they are complete
+    if manifest is None and not reload:
+        return zipped_filenames if selected is None else [x for x in zipped_filenames if x in selected]
+    files_by_date = {}
+    for zipped_filename in zipped_filenames:
+        files_by_date.setdefault(date_string_from_file_name(zipped_filename), []).append(zipped_filename)
+    to_load = []
+    for date_string, date_files in files_by_date.items():
+        wanted = date_files if selected is None else [x for x in date_files if x in selected]
+        if not wanted:
+            continue
+        reason = 'a reload was asked for'
+        if not reload:
+            states = {x: manifest.file_state(os.path.join(data_path, x).replace("\\", "/"), kdb_dir) for x in date_files}
+            if all(states[x] == COMPLETE for x in wanted):
+                continue
+            if not whole_days and all(state in (NEW, COMPLETE) for state in states.values()):
+                to_load.extend(x for x in wanted if states[x] == NEW)
+                continue
+            reason = 'its sources changed or were not loaded completely'
+        if whole_days:
+            to_load.extend(date_files)
+            continue
+        logging.info(f'Rewriting {feed} partition {date_string} in {kdb_dir}, {reason}')
+        reset_partition(kdb_dir, date_string, FEEDS[feed].table)
+        if manifest is not None:
+            manifest.forget_partition(kdb_dir, date_string)
+        to_load.extend(date_files)
+    skipped = (len(zipped_filenames) if selected is None else len(selected)) - len(to_load)
+    if skipped > 0:
+        logging.info(f'Skipping {skipped} {feed} files already loaded into {kdb_dir}')
+    return to_load
 
 
-def process_pattern_fileBatch(toMatchPattern, process_function, q, data_path, temp_dir, kdb_dir):
+def file_load_mode(schema, stream):
+    if schema.chunk_rows is not None:
+        return 'chunked'
+    return 'stream' if stream else 'extract'
+
+
+def feed_source_dir(feed, src_root=None):
+    return os.path.join(SRC_ROOT_DIR if src_root is None else src_root, FEEDS[feed].venue).replace("\\", "/")
+
+
+def feed_kdb_dir(feed, kdb_root=None):
+    return os.path.join(KDB_ROOT_DIR if kdb_root is None else kdb_root, FEEDS[feed].hdb).replace("\\", "/")
+
+
+def month_file_pattern(month_pattern, suffix):
+    return "^" + month_pattern + "[0-9]{2}_\\S+" + suffix + "$"
+
+
+def find_pattern_files(toMatchPattern, data_path, source_index=None):
+    # source_index: a file_index.SourceIndex answering from its listing of data_path instead of listing the directory again
     match_pattern = re.compile(toMatchPattern)
     
     # make sure the file patterns are mutually exclusive, else you will be loading multiple times the same data
-    gz_csv_files = [x for x in os.listdir(data_path) if match_pattern.match(x) is not None]
+    if source_index is not None:
+        gz_csv_files = source_index.match(toMatchPattern, data_path)
+    else:
+        gz_csv_files = [x for x in os.listdir(data_path) if match_pattern.match(x) is not None]
     if not gz_csv_files:
         logging.error(f"No  files found for pattern {toMatchPattern} in directory: {data_path}")
-        return False
+        return []
     gz_csv_files.sort()
     logging.info(f"Found files for pattern {toMatchPattern} : {str(gz_csv_files)}")
-    for zipped_filename in gz_csv_files:
-        process_function(q, zipped_filename, parent_dir=data_path, temp_dir=temp_dir, kdb_dir=kdb_dir)
+    return gz_csv_files
+
+
+def source_isin(full_input_filename):
+    # the ISIN of the first row, each source file holds one instrument; only the header and the first row are decompressed
+    with gzip.open(full_input_filename, 'rb') as f_in:
+        header = f_in.readline().rstrip(b"\r\n").split(b"|")
+        first_row = f_in.readline().rstrip(b"\r\n").split(b"|")
+    if SYM_SOURCE_COLUMN.encode() not in header or len(first_row) != len(header):
+        return None
+    return first_row[header.index(SYM_SOURCE_COLUMN.encode())].decode('latin-1')
+
+
+def select_feed_files(feed, data_path, selection=None, source_index=None):
+    # (names of the source files of the dates holding a selected file, names of the selected files or None for all of them); the dates
+    # and instrument ids are answered from the listing of the source index and the ISINs from the first row of the remaining files, so
+    # the files of other dates and instruments are never opened
+    selection = FileSelection() if selection is None else selection
+    source_index = SourceIndex() if source_index is None else source_index
+    source_files = source_index.files(data_path, FEEDS[feed].file_suffix, selection.start_date.replace('-', ''), selection.end_date.replace('-', ''))
+    if selection.instruments is None and selection.isins is None:
+        return [x.name for x in source_files], None
+    selected = [x for x in source_files if selection.instruments is None or x.instrument in selection.instruments]
+    if selection.isins is not None:
+        selected = [x for x in selected if source_isin(os.path.join(data_path, x.name).replace("\\", "/")) in selection.isins]
+    dates = {x.date for x in selected}
+    logging.info(f'Selected {len(selected)} of the {len(source_files)} {feed} files between {selection.start_date} and {selection.end_date} '
+                 f'in {data_path}, on {len(dates)} dates')
+    return [x.name for x in source_files if x.date in dates], {x.name for x in selected}
+
+
+def feed_files_to_load(feed, data_path, kdb_dir, manifest=None, selection=None, source_index=None, whole_days=False):
+    # the selected files of the feed that still have to be loaded (plan_feed_files), sorted by name
+    selection = FileSelection() if selection is None else selection
+    date_files, selected = select_feed_files(feed, data_path, selection, source_index)
+    if not date_files:
+        logging.error(f'No {feed} files between {selection.start_date} and {selection.end_date} in directory: {data_path}')
+        return []
+    return plan_feed_files(manifest, feed, data_path, date_files, kdb_dir, whole_days, selected, selection.reload)
+
+
+def prefetch_line_chunks(zipped_filename, reserve, parent_dir=None, executor=None, chunk_lines=STREAM_CHUNK_LINES, file_metrics=None):
+    # file_metrics: zipped filename => FileMetrics of the file, the decompression is timed here in the prefetch thread
+    full_input_filename = zipped_filename if parent_dir is None else os.path.join(parent_dir, zipped_filename).replace("\\", "/")
+    chunks = split_line_chunks(read_gz_blocks(full_input_filename, executor), chunk_lines)
+    if file_metrics is not None:
+        chunks = file_metrics[zipped_filename].timed_items('extract', chunks)
+    for header, text, n_lines in chunks:
+        reserve(len(text))
+        yield (header, text, n_lines), len(text)
+
+
+def prefetch_extracted(zipped_filename, reserve, parent_dir=None, temp_dir=None, file_metrics=None):
+    # reserves the disk space the copy and the extracted file will take in temp_dir before creating them
+    full_input_filename = zipped_filename if parent_dir is None else os.path.join(parent_dir, zipped_filename).replace("\\", "/")
+    n_bytes = gzip_uncompressed_size(full_input_filename) + (0 if temp_dir is None else os.path.getsize(full_input_filename))
+    reserve(n_bytes)
+    yield copy_and_extract(zipped_filename, parent_dir, temp_dir, None if file_metrics is None else file_metrics[zipped_filename]), n_bytes
+
+
+def process_pattern_fileBatch(toMatchPattern, feed, q, data_path, temp_dir, kdb_dir, stream=STREAM_INGEST, manifest=None, prefetch_files=PREFETCH_FILES,
+                              metrics=None, source_index=None, whole_days=WHOLE_DAY_WRITES, dedup=DEDUP_ROWS):
+    gz_csv_files = find_pattern_files(toMatchPattern, data_path, source_index)
+    if not gz_csv_files:
+        return False
+    process_feed_files(q, feed, plan_feed_files(manifest, feed, data_path, gz_csv_files, kdb_dir, whole_days), data_path, temp_dir, kdb_dir, stream,
+                       manifest, prefetch_files, metrics, whole_days, dedup)
+    return True
+
+
+def process_feed_files(q, feed, gz_csv_files, data_path, temp_dir, kdb_dir, stream=STREAM_INGEST, manifest=None, prefetch_files=PREFETCH_FILES,
+                       metrics=None, whole_days=WHOLE_DAY_WRITES, dedup=DEDUP_ROWS):
+    # loads the files (names in data_path, sorted, as plan_feed_files returns them) one by one or, with whole_days, one date at a time
+    if whole_days:
+        # the files come sorted by name, so the files of a date follow each other
+        process_days = partial(process_feed_days, q, feed, parent_dir=data_path, temp_dir=temp_dir, kdb_dir=kdb_dir, stream=stream, manifest=manifest,
+                               metrics=metrics, dedup=dedup)
+    schema = FEEDS[feed]
+    if prefetch_files <= 0:
+        if whole_days:
+            process_days((x, None, None) for x in gz_csv_files)
+            return
+        for date_string, date_files in groupby(gz_csv_files, key=date_string_from_file_name):
+            for zipped_filename in date_files:
+                process_feed_file(q, feed, zipped_filename, parent_dir=data_path, temp_dir=temp_dir, kdb_dir=kdb_dir, stream=stream,
+                                  manifest=manifest, metrics=metrics)
+            if schema.chunk_rows is not None:
+                sort_chunked_partition(q, kdb_dir, date_string, schema.table, schema.partition_by)
+        return
+    
+    # the prefetch threads time their part of the work into the same FileMetrics the file is recorded with
+    file_metrics = {x: FileMetrics(feed, os.path.join(data_path, x).replace("\\", "/"), file_load_mode(schema, stream)) for x in gz_csv_files}
+    with ThreadPoolExecutor(max_workers=DECOMPRESS_THREADS, thread_name_prefix='inflate') as decompress_executor:
+        if schema.chunk_rows is not None:
+            produce = partial(prefetch_line_chunks, parent_dir=data_path, executor=decompress_executor, chunk_lines=schema.chunk_rows,
+                              file_metrics=file_metrics)
+        elif stream:
+            produce = partial(prefetch_line_chunks, parent_dir=data_path, executor=decompress_executor, file_metrics=file_metrics)
+        else:
+            produce = partial(prefetch_extracted, parent_dir=data_path, temp_dir=temp_dir, file_metrics=file_metrics)
+        prefetched_files = prefetch_in_order(gz_csv_files, produce, prefetch_files, PREFETCH_BUDGET_BYTES)
+        if whole_days:
+            process_days((x, prefetched, file_metrics[x]) for x, prefetched in prefetched_files)
+            return
+        for date_string, date_files in groupby(prefetched_files, key=lambda x: date_string_from_file_name(x[0])):
+            for zipped_filename, prefetched in date_files:
+                process_feed_file(q, feed, zipped_filename, parent_dir=data_path, temp_dir=temp_dir, kdb_dir=kdb_dir, stream=stream,
+                                  manifest=manifest, prefetched=prefetched, metrics=metrics, file_metrics=file_metrics[zipped_filename])
+            if schema.chunk_rows is not None:
+                sort_chunked_partition(q, kdb_dir, date_string, schema.table, schema.partition_by)
+
+
+def process_feed_days(q, feed, day_files, **options):
+    # day_files: (zipped filename, prefetched, FileMetrics) sorted by date, handed to process_feed_day one date at a time
+    for date_string, date_files in groupby(day_files, key=lambda x: date_string_from_file_name(x[0])):
+        process_feed_day(q, feed, date_string, date_files, **options)
+
+
+def iso_date(value):
+    # zero padded, so the dates compare as strings and become the YYYYMMDD of the file names (2018-3-9 => 2018-03-09)
+    return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+
+
+def add_selection_arguments(parser):
+    # the command line of the loaders: which files to load and where they come from and go to
+    parser.add_argument('--feeds', nargs='*', default=list(FEEDS), choices=list(FEEDS))
+    parser.add_argument('--start', type=iso_date, default=START_DATE, help='first date to load, YYYY-MM-DD')
+    parser.add_argument('--end', type=iso_date, default=END_DATE, help='last date to load, YYYY-MM-DD (inclusive)')
+    parser.add_argument('--instruments', nargs='*', help='instrument ids (as in the file names) to load, default all')
+    parser.add_argument('--isins', nargs='*', help='ISINs to load, matched against the first row of each file before it is parsed')
+    parser.add_argument('--reload', action='store_true', help='write the selected dates again even if they are loaded already')
+    parser.add_argument('--src-root', default=SRC_ROOT_DIR, help='directory holding the source files, one sub directory per venue')
+    parser.add_argument('--kdb-root', default=KDB_ROOT_DIR, help='directory holding the HDBs, one sub directory per feed')
+    parser.add_argument('--manifest', default=MANIFEST_FILE, help='ingestion manifest used to skip files that are already loaded')
+    parser.add_argument('--source-index', default=SOURCE_INDEX_FILE, help='cached listings of the source directories')
+    parser.add_argument('--metrics', default=METRICS_FILE, help='json lines file receiving the timings, sizes and row counts of every file')
+    parser.add_argument('--no-validation', action='store_true', help='do not check the partitions written by this run (validate_hdb.py)')
+    parser.add_argument('--log-dir', default=LOG_DIR, help='where the log file of the run goes, created if missing')
+
+
+def file_selection(args):
+    if args.start > args.end:
+        raise ValueError(f'--start {args.start} is after --end {args.end}')
+    return FileSelection(args.start, args.end, None if args.instruments is None else set(args.instruments),
+                         None if args.isins is None else set(args.isins), args.reload)
 
 
 def main():
-    # # global so shared across potential processes (READ ONLY)
+    parser = argparse.ArgumentParser(description='Load the EUX trade/order/book files into KDB, all of them or only the dates, feeds and '
+                                                 'instruments asked for.')
+    add_selection_arguments(parser)
+    parser.add_argument('--extract-dir', default=EXTRACT_DIR, help='where files are copied and extracted when not streaming')
+    parser.add_argument('--port', type=int, default=Q_PORT_NUMBER, help='port of the Q process (of the first one with --workers)')
+    parser.add_argument('--workers', type=int, default=1, help='number of Q processes on consecutive ports loading files in parallel')
+    args = parser.parse_args()
+    selection = file_selection(args)
+    
+    setup_logging(log_dir=args.log_dir)
     logging.info('Started')
-    # from 201705 201902 => for if we want to try this multiprocessing
-    starting_month_patterns = [x.strftime("%Y%m") for x in list(pd.date_range("2017-05-01", "2019-03-01", freq='M'))]
+    logging.info(f'Loading {args.feeds} from {args.start} to {args.end}'
+                 f"{'' if args.instruments is None else f' for instruments {args.instruments}'}"
+                 f"{'' if args.isins is None else f' for ISINs {args.isins}'}{', reloading loaded dates' if args.reload else ''}")
+    if args.workers > 1 and PARSE_ENGINE == 'python':
+        raise ValueError('Only the Q engine loads with several workers')
     
-    data_path = SRC_DATA_DIR
-    if not os.path.exists(data_path):
-        logging.error(f"Failed to open directory for reading: {data_path}")
+    manifest = IngestManifest(args.manifest)
+    metrics = MetricsRecorder(args.metrics)
+    source_index = SourceIndex(args.source_index)
+    # whole day plans load every file of a date again and count on the staging swap to replace its partition, which only the Q engine
+    # does on a single worker; the python engine appends, so it must get the file by file plan (changed dates are reset first)
+    whole_days = WHOLE_DAY_WRITES and args.workers == 1 and PARSE_ENGINE != 'python'
+    if WHOLE_DAY_WRITES and not whole_days:
+        logging.warning('Whole day writes need the Q engine and a single worker, loading file by file')
+    work = []  # (feed, source directory, hdb directory, files to load)
+    for feed in args.feeds:
+        data_path = feed_source_dir(feed, args.src_root)
+        if not os.path.exists(data_path):
+            logging.error(f"Failed to open directory for reading: {data_path}")
+            continue
+        kdb_dir = feed_kdb_dir(feed, args.kdb_root)
+        work.append((feed, data_path, kdb_dir, feed_files_to_load(feed, data_path, kdb_dir, manifest, selection, source_index, whole_days)))
+    logging.info(f'{sum(len(x[3]) for x in work)} files to load')
+    
+    if args.workers > 1:
+        import parallel_loader
+        from scheduler import CostModel
+        pool = parallel_loader.open_q_pool([args.port + i for i in range(args.workers)])
+        connections = [q for q, _ in pool]
     else:
-        port_num = Q_PORT_NUMBER
-        q = qconnection.QConnection(host='localhost', port=port_num)  # initialize connection (make sure it is multi-threaded startup)
+        from qconn import ManagedQConnection
+        q = ManagedQConnection(host='localhost', port=args.port)  # initialize connection (make sure it is multi-threaded startup)
         q.open()
         logging.info('IPC version: %s. Is connected: %s' % (q.protocol_version, q.is_connected()))
+        connections = [q]
+    run_started = datetime.now().isoformat()
+    sink = None
+    if PARSE_ENGINE == 'python' and PARQUET_ROOT_DIR is not None:
+        from parquet_sink import ColumnarSink
+        sink = ColumnarSink(PARQUET_ROOT_DIR)
+    
+    try:
+        if args.workers > 1:
+            work_units = [(feed, data_path, x) for feed, data_path, _, gz_csv_files in work for x in gz_csv_files]
+            failed_units = parallel_loader.load_parallel(pool, work_units, args.extract_dir, manifest=manifest, metrics=metrics,
+                                                         cost_model=CostModel(args.metrics), source_index=source_index,
+                                                         kdb_root=args.kdb_root)
+            if failed_units:
+                logging.error(f'Failed to load {len(failed_units)} files: {failed_units}')
+        else:
+            for feed, data_path, kdb_dir, gz_csv_files in work:
+                if PARSE_ENGINE == 'python':
+                    import py_engine
+                    py_engine.process_files_py(q, feed, gz_csv_files, kdb_dir, parent_dir=data_path, manifest=manifest, metrics=metrics, sink=sink)
+                else:
+                    process_feed_files(q, feed, gz_csv_files, data_path, args.extract_dir, kdb_dir, manifest=manifest, metrics=metrics,
+                                       whole_days=whole_days)
+                logging.info(f'Finished loading {feed} from {data_path}')
         
-        for month_pattern in starting_month_patterns:
-            process_pattern_fileBatch("^" + month_pattern + "[0-9]{2}_\S+_MKtrade.csv.gz$", process_trade_file, q, data_path=SRC_DATA_DIR, temp_dir=EXTRACT_DIR,
-                                      kdb_dir=TRADES_DIR)
-        logging.info(f'Finished loading trades from {data_path}')
-        for month_pattern in starting_month_patterns:
-            process_pattern_fileBatch("^" + month_pattern + "[0-9]{2}_\S+_Order.csv.gz$", process_order_file, q, data_path=SRC_DATA_DIR, temp_dir=EXTRACT_DIR,
-                                      kdb_dir=ORDERS_DIR)
-        logging.info(f'Finished loading orders from {data_path}')
-        for month_pattern in starting_month_patterns:
-            process_pattern_fileBatch("^" + month_pattern + "[0-9]{2}_\S+_Book.csv.gz$", process_book_file, q, data_path=SRC_DATA_DIR, temp_dir=EXTRACT_DIR,
-                                      kdb_dir=BOOKS_DIR)
-        logging.info(f'Finished loading books from {data_path}')
-        
-        q.close()
-        logging.info(f'Q Connection. Is connected: {q.is_connected()}')
+        if VALIDATE_AFTER_LOAD and not args.no_validation:
+            import validate_hdb
+            validate_hdb.validate_feeds(connections, [x[0] for x in work], manifest, updated_since=run_started, kdb_root=args.kdb_root)
+    finally:
+        logging.info(f'Manifest (feed, status, files, rows): {manifest.summary()}')
+        manifest.close()
+        source_index.save()
+        metrics.log_summary()
+        metrics.close()
+        if args.workers > 1:
+            parallel_loader.close_q_pool(pool)
+        else:
+            q.close()
+            logging.info(f'Q Connection. Is connected: {q.is_connected()}')
     
     logging.info('Finished')
 
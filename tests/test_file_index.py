@@ -0,0 +1,25 @@
+from file_index import SourceIndex
+
+
+def test_instrument_ids_with_underscores(tmp_path):
+    for name in ('20170502_4711_MKtrade.csv.gz', '20170502_FDAX_1706_Book.csv.gz', '20170503_FDAX_1706_Book.csv.gz', 'notes.txt'):
+        (tmp_path / name).write_bytes(b'')
+    index = SourceIndex()
+    books = index.files(str(tmp_path), '_Book.csv.gz', start_date='20170503')
+    assert [(x.date, x.instrument, x.file_type) for x in books] == [('20170503', 'FDAX_1706', 'Book')]
+    assert [x.instrument for x in index.files(str(tmp_path), '_MKtrade.csv.gz')] == ['4711']
+    assert index.match(r'.*\.txt$', str(tmp_path)) == ['notes.txt']
+
+
+def test_cached_listing_is_reused(tmp_path):
+    data_path = tmp_path / 'data'
+    data_path.mkdir()
+    (data_path / '20170502_FDAX_1706_Book.csv.gz').write_bytes(b'')
+    cache_path = str(tmp_path / 'index.json')
+    index = SourceIndex(cache_path)
+    index.directory(str(data_path))
+    index.save()
+    cached = SourceIndex(cache_path)
+    assert not cached.changed
+    assert [x.instrument for x in cached.files(str(data_path), '_Book.csv.gz')] == ['FDAX_1706']
+    assert not cached.changed
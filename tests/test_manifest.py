@@ -0,0 +1,38 @@
+import os
+
+from manifest import IngestManifest, NEW, COMPLETE, CHANGED, INCOMPLETE
+
+
+def source_file(tmp_path, name, data=b'data'):
+    path = str(tmp_path / name).replace("\\", "/")
+    with open(path, 'wb') as f_out:
+        f_out.write(data)
+    return path
+
+
+def test_file_states(tmp_path):
+    manifest = IngestManifest(str(tmp_path / 'manifest.db'))
+    loaded, started, failed = [source_file(tmp_path, x) for x in ('a.gz', 'b.gz', 'c.gz')]
+    assert manifest.file_state(loaded, 'kdb') == NEW
+    manifest.mark_complete(loaded, 'kdb', 'trades', '2017.05.02', 10)
+    manifest.mark_started(started, 'kdb', 'trades', '2017.05.02')
+    manifest.mark_failed(failed, 'kdb', 'trades', '2017.05.02')
+    assert [manifest.file_state(x, 'kdb') for x in (loaded, started, failed)] == [COMPLETE, INCOMPLETE, NEW]
+    assert manifest.file_state(loaded, 'other kdb') == NEW
+    source_file(tmp_path, 'a.gz', b'changed data')
+    assert manifest.file_state(loaded, 'kdb') == CHANGED
+    manifest.close()
+
+
+def test_partition_expectations_add_up_the_files(tmp_path):
+    manifest = IngestManifest(str(tmp_path / 'manifest.db'))
+    first, second, empty = [source_file(tmp_path, x) for x in ('a.gz', 'b.gz', 'c.gz')]
+    manifest.mark_complete(first, 'kdb', 'trades', '2017.05.02', 2, {'rows': 2, 'min_time': 5, 'max_time': 9, 'checksums': {'Price': 3}})
+    manifest.mark_complete(second, 'kdb', 'trades', '2017.05.02', 1, {'rows': 1, 'min_time': 1, 'max_time': 4, 'checksums': {'Price': 4}})
+    manifest.mark_complete(empty, 'kdb', 'trades', '2017.05.03', 0, {'rows': 0, 'min_time': None, 'max_time': None, 'checksums': {}})
+    assert manifest.partition_expectations('kdb') == {
+        '2017.05.02': {'rows': 3, 'min_time': 1, 'max_time': 9, 'checksums': {'Price': 7}, 'files': 2},
+        '2017.05.03': {'rows': 0, 'min_time': None, 'max_time': None, 'checksums': {}, 'files': 1}}
+    assert list(manifest.partition_expectations('kdb', start_date='2017.05.03')) == ['2017.05.03']
+    manifest.close()
+    assert os.path.isfile(str(tmp_path / 'manifest.db'))
@@ -0,0 +1,34 @@
+import gzip
+
+from prefetch import split_line_chunks
+from setup_kdb import read_gz_line_chunks
+
+
+def test_split_line_chunks_cuts_blocks_at_whole_lines():
+    blocks = [b'\r\na|b\r\n1|2\r', b'\n3|4\n5|', b'6\r\n7|8']
+    assert list(split_line_chunks(blocks, 2)) == [(b'a|b', b'1|2\r\n3|4\n', 2), (b'a|b', b'5|6\r\n7|8', 2)]
+
+
+def test_split_line_chunks_holds_at_least_chunk_lines():
+    blocks = [b'a|b\n1|2\n', b'3|4\n5|6\n7|8\n', b'9|10\n']
+    assert list(split_line_chunks(blocks, 2)) == [(b'a|b', b'1|2\n3|4\n5|6\n7|8\n', 4), (b'a|b', b'9|10\n', 1)]
+
+
+def test_blank_lines_at_the_end_are_not_counted():
+    assert list(split_line_chunks([b'a|b\n1|2\n3|4\n', b'\r\n\r\n'], 2)) == [(b'a|b', b'1|2\n3|4\n', 2)]
+    assert list(split_line_chunks([b'a|b\n1|2\n3|4\n\r\n'], 5)) == [(b'a|b', b'1|2\n3|4\n\r\n', 2)]
+
+
+def test_header_only_file_has_no_chunks(tmp_path):
+    path = str(tmp_path / '20170502_4711_MKtrade.csv.gz')
+    with gzip.open(path, 'wb') as f_out:
+        f_out.write(b'a|b\r\n')
+    assert list(read_gz_line_chunks(path)) == []
+
+
+def test_read_gz_line_chunks_splits_like_the_prefetch(tmp_path):
+    path = str(tmp_path / '20170502_4711_MKtrade.csv.gz')
+    data = b'a|b\n' + b''.join(b'%d|%d\r\n' % (i, i) for i in range(10))
+    with gzip.open(path, 'wb') as f_out:
+        f_out.write(data)
+    assert list(read_gz_line_chunks(path, 4)) == list(split_line_chunks([data[:7], data[7:]], 4))
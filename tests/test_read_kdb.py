@@ -0,0 +1,53 @@
+import os
+
+import numpy as np
+import pytest
+
+from read_kdb import read_table, table_layout
+from setup_kdb import partition_table_dir
+
+
+def q_header(q_type, n):
+    # kdb+ 3 header of a list file: 0xfe 0x20, type, attribute, 4 bytes padding, count
+    return b'\xfe\x20' + bytes([q_type, 0]) + b'\0' * 4 + np.int64(n).tobytes()
+
+
+def write_symbol_file(path, symbols):
+    with open(path, 'wb') as f_out:
+        f_out.write(q_header(11, len(symbols)) + b''.join(x.encode() + b'\0' for x in symbols))
+
+
+def write_column(path, q_type, values):
+    with open(path, 'wb') as f_out:
+        f_out.write(q_header(q_type, len(values)) + values.tobytes())
+
+
+@pytest.fixture
+def hdb(tmp_path):
+    # one trades partition of 3 rows, syms A A B, with the columns in another order than the feed schema
+    kdb_dir = str(tmp_path).replace("\\", "/")
+    write_symbol_file(os.path.join(kdb_dir, 'sym'), ['A', 'B'])
+    table_dir = partition_table_dir(kdb_dir, '2017.05.02', 'trades')
+    os.makedirs(table_dir)
+    write_symbol_file(table_dir + '.d', ['sym', 'time', 'Price'])
+    write_column(table_dir + 'sym', 20, np.array([0, 0, 1], np.int32))
+    write_column(table_dir + 'time', 12, np.array([0, 1, 2], np.int64))
+    write_column(table_dir + 'Price', 9, np.array([1., 2., 3.]))
+    return kdb_dir
+
+
+def test_layout_comes_from_the_partition(hdb):
+    assert table_layout(hdb, '2017.05.02', 'trades') == [('sym', 'S'), ('time', 'P'), ('Price', 'F')]
+
+
+def test_read_table_selects_syms_and_columns(hdb):
+    table = read_table('trades', syms=['B'], kdb_dir=hdb)
+    assert list(table) == ['sym', 'time', 'Price']
+    assert table['sym'].tolist() == [b'B']
+    assert table['time'][0] == np.datetime64('2000-01-01T00:00:00.000000002')
+    assert read_table('trades', columns=['Price', 'sym'], kdb_dir=hdb, chunk_rows=2)['Price'].tolist() == [1., 2., 3.]
+
+
+def test_unknown_columns_are_refused(hdb):
+    with pytest.raises(ValueError):
+        read_table('trades', columns=['Size'], kdb_dir=hdb)
@@ -0,0 +1,79 @@
+import json
+import threading
+
+from scheduler import CostModel, WorkStealingScheduler, WorkItem, MB, Q_MEMORY_PER_CSV_BYTE, DEFAULT_CSV_BYTES_PER_ROW
+
+
+def items(*costs, memory=0):
+    return [WorkItem(f'file{i}', cost, memory) for i, cost in enumerate(costs)]
+
+
+def test_lpt_deals_the_largest_files_to_the_least_loaded_worker():
+    scheduler = WorkStealingScheduler(items(1, 3, 5, 2, 4, 3), 2)
+    assert [[x.cost for x in queue] for queue in scheduler.queues] == [[5, 3, 1], [4, 3, 2]]
+    assert scheduler.loads == [9, 9]
+
+
+def test_lpt_keeps_files_off_workers_they_do_not_fit_on():
+    work = [WorkItem('large', 5, 80), WorkItem('small', 1, 10), WorkItem('medium', 2, 10)]
+    scheduler = WorkStealingScheduler(work, 2, worker_memory=[100, 50])
+    assert [[x.unit for x in queue] for queue in scheduler.queues] == [['large'], ['medium', 'small']]
+
+
+def test_worker_takes_its_largest_then_steals_the_smallest():
+    scheduler = WorkStealingScheduler(items(6, 5, 1, 1), 2)
+    assert [[x.unit for x in queue] for queue in scheduler.queues] == [['file0', 'file3'], ['file1', 'file2']]
+    assert [scheduler.next_item(1).unit for _ in range(2)] == ['file1', 'file2']
+    assert scheduler.n_stolen == 0
+    stolen = scheduler.next_item(1)
+    assert stolen.unit == 'file3' and scheduler.n_stolen == 1
+    assert scheduler.loads == [6, 0]
+    assert scheduler.next_item(0).unit == 'file0'
+
+
+def test_files_wait_on_the_memory_budget():
+    scheduler = WorkStealingScheduler(items(2, 1, memory=60), 2, memory_budget=100)
+    first = scheduler.next_item(0)
+    taken = []
+    waiting = threading.Thread(target=lambda: taken.append(scheduler.next_item(1)))
+    waiting.start()
+    waiting.join(0.2)
+    assert waiting.is_alive() and not taken
+    scheduler.done(first)
+    waiting.join(5)
+    assert not waiting.is_alive() and [x.unit for x in taken] == ['file1']
+
+
+def test_file_larger_than_the_budget_runs_alone():
+    scheduler = WorkStealingScheduler(items(1, memory=500), 1, memory_budget=100)
+    assert scheduler.next_item(0).unit == 'file0'
+
+
+def test_workers_stop_once_nothing_is_left_for_them():
+    work = [WorkItem('large', 5, 80), WorkItem('small', 1, 10)]
+    scheduler = WorkStealingScheduler(work, 2, worker_memory=[100, 50])
+    assert scheduler.next_item(1).unit == 'small'
+    assert scheduler.next_item(1) is None  # the large file is left but does not fit this worker
+    large = scheduler.next_item(0)
+    scheduler.done(large)
+    assert scheduler.next_item(0) is None
+    threads = [threading.Thread(target=scheduler.next_item, args=(x,)) for x in range(2)]
+    for thread in threads:
+        thread.start()
+        thread.join(5)
+        assert not thread.is_alive()
+
+
+def test_cost_model_from_the_metrics_history(tmp_path):
+    metrics_path = tmp_path / 'metrics.jsonl'
+    records = [{'status': 'complete', 'feed': 'trades', 'source_path': 'a.gz', 'bytes_in': MB, 'csv_bytes': 4 * MB, 'rows_in': 1000,
+                'stages_s': {'extract': 1.0, 'load': 2.0}},
+               {'status': 'complete', 'feed': 'trades', 'source_path': 'b.gz', 'bytes_in': MB, 'csv_bytes': 4 * MB, 'rows_in': 1000,
+                'stages_s': {'extract': 0.5, 'load': 0.5}},
+               {'status': 'failed', 'feed': 'trades', 'source_path': 'c.gz', 'bytes_in': MB, 'stages_s': {'extract': 100.0}}]
+    metrics_path.write_text('\n'.join(json.dumps(x) for x in records) + '\nnot json\n')
+    cost_model = CostModel(str(metrics_path))
+    assert cost_model.cost('trades', 'a.gz', MB) == 3.0
+    assert cost_model.cost('trades', 'c.gz', 2 * MB) == 4.0  # 2 s/MB over the complete loads
+    assert cost_model.memory('trades', MB) == int(4 * MB * Q_MEMORY_PER_CSV_BYTE)
+    assert cost_model.memory('books', 1000 * MB) == int(500000 * DEFAULT_CSV_BYTES_PER_ROW * Q_MEMORY_PER_CSV_BYTE)
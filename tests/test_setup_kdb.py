@@ -0,0 +1,36 @@
+import argparse
+
+import pytest
+
+from file_index import SourceIndex
+from setup_kdb import FileSelection, iso_date, add_selection_arguments, file_selection, select_feed_files
+
+
+def parse_selection(*argv):
+    parser = argparse.ArgumentParser()
+    add_selection_arguments(parser)
+    return file_selection(parser.parse_args(list(argv)))
+
+
+def test_iso_date_is_zero_padded():
+    assert iso_date('2018-3-9') == '2018-03-09'
+    assert iso_date('2018-03-09') == '2018-03-09'
+    with pytest.raises(ValueError):
+        iso_date('2018.03.09')
+
+
+def test_dates_without_padding_compare_as_dates():
+    selection = parse_selection('--start', '2018-3-5', '--end', '2018-03-09')
+    assert (selection.start_date, selection.end_date) == ('2018-03-05', '2018-03-09')
+    with pytest.raises(ValueError):
+        parse_selection('--start', '2018-03-10', '--end', '2018-3-9')
+
+
+def test_select_feed_files_keeps_to_the_date_range(tmp_path):
+    for name in ['20180304_4711_MKtrade.csv.gz', '20180305_4711_MKtrade.csv.gz', '20180309_4711_MKtrade.csv.gz',
+                 '20180310_4711_MKtrade.csv.gz', '20181120_4711_MKtrade.csv.gz', '20180305_4711_Book.csv.gz']:
+        (tmp_path / name).write_bytes(b'')
+    selection = FileSelection(iso_date('2018-03-05'), iso_date('2018-3-9'))
+    date_files, selected = select_feed_files('trades', str(tmp_path), selection, SourceIndex())
+    assert date_files == ['20180305_4711_MKtrade.csv.gz', '20180309_4711_MKtrade.csv.gz']
+    assert selected is None
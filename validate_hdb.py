@@ -0,0 +1,146 @@
+import os
+import sys
+import json
+import queue
+import logging
+import argparse
+import threading
+from qpython.qtype import QException
+
+from feeds import FEEDS, q_table_stats
+from manifest import IngestManifest, table_stats
+from qconn import ManagedQConnection
+from setup_kdb import Q_PORT_NUMBER, MANIFEST_FILE, KDB_ROOT_DIR, LOG_DIR, setup_logging, feed_kdb_dir, partition_table_dir, iso_date
+
+# checks after a load that every date partition holds what we wrote into it: the manifest keeps the row count, time range and column
+# checksums (feeds.q_table_stats) of each file as Q had it just before writing, summed up per date they have to match the same stats
+# computed from the partition on disk; Q maps the one splayed table with get instead of loading the HDB, and the dates are spread over
+# a pool of Q connections
+
+N_WORKERS = 4  # default number of Q processes validating in parallel
+OK, MISMATCH, MISSING, UNREADABLE = 'ok', 'mismatch', 'missing', 'unreadable'
+
+
+def q_partition_stats(kdb_dir, date_string, table_name):
+    # the enumerated sym column needs the sym file of the HDB as `sym`, the columns themselves are mapped from the partition directory
+    return f'{{sym::get `:{kdb_dir}/sym; {q_table_stats("get x")}}}`:{partition_table_dir(kdb_dir, date_string, table_name)}'
+
+
+def compare_stats(expected, actual):
+    # list of differences, empty if the partition holds what we wrote; files loaded before the manifest kept stats only have a row count
+    problems = []
+    if expected['rows'] != actual['rows']:
+        problems.append(f"{actual['rows']} rows instead of {expected['rows']}")
+    if expected['min_time'] is not None and (expected['min_time'], expected['max_time']) != (actual['min_time'], actual['max_time']):
+        problems.append(f"time range {actual['min_time']}-{actual['max_time']} instead of {expected['min_time']}-{expected['max_time']}")
+    if expected['checksums'] is not None:
+        for column in sorted(set(expected['checksums']) | set(actual['checksums'])):
+            if expected['checksums'].get(column) != actual['checksums'].get(column):
+                problems.append(f"checksum of {column} is {actual['checksums'].get(column)} instead of {expected['checksums'].get(column)}")
+    return problems
+
+
+def validate_partition(q, feed, kdb_dir, date_string, expected):
+    schema = FEEDS[feed]
+    result = {'feed': feed, 'date': date_string, 'files': expected['files'], 'rows': expected['rows'], 'status': OK, 'problems': []}
+    if not os.path.isdir(partition_table_dir(kdb_dir, date_string, schema.table)):
+        if expected['rows'] > 0:  # the files of a date without a partition had no data
+            result['status'], result['problems'] = MISSING, ['no partition']
+        return result
+    try:
+        actual = table_stats(q(q_partition_stats(kdb_dir, date_string, schema.table)))
+    except QException as e:
+        result['status'], result['problems'] = UNREADABLE, [e.args[0].decode() if e.args and isinstance(e.args[0], bytes) else str(e)]
+        return result
+    if actual is None:
+        result['status'], result['problems'] = UNREADABLE, ['Q returned no stats']
+        return result
+    result['problems'] = compare_stats(expected, actual)
+    if result['problems']:
+        result['status'] = MISMATCH
+    return result
+
+
+def validation_worker(q, work_queue, results):
+    while True:
+        try:
+            feed, kdb_dir, date_string, expected = work_queue.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            q.ensure_connected()
+            results.append(validate_partition(q, feed, kdb_dir, date_string, expected))
+        except Exception as e:
+            logging.exception(f'Failed to validate {feed} {date_string}')
+            results.append({'feed': feed, 'date': date_string, 'files': expected['files'], 'rows': expected['rows'], 'status': UNREADABLE,
+                            'problems': [repr(e)]})
+        finally:
+            work_queue.task_done()
+
+
+def validate_feeds(connections, feeds, manifest, start_date=None, end_date=None, updated_since=None, kdb_root=None):
+    # validates the loaded dates (YYYY.MM.DD, optionally only those with a file loaded since updated_since) of the feeds, one date per Q
+    # connection at a time; returns a result per partition, sorted by feed and date
+    work_queue = queue.Queue()
+    for feed in feeds:
+        kdb_dir = feed_kdb_dir(feed, kdb_root)
+        for date_string, expected in sorted(manifest.partition_expectations(kdb_dir, start_date, end_date, updated_since).items()):
+            work_queue.put((feed, kdb_dir, date_string, expected))
+    logging.info(f'Validating {work_queue.qsize()} partitions with {len(connections)} Q connections')
+    results = []
+    workers = [threading.Thread(target=validation_worker, name=f'validate-{i}', args=(q, work_queue, results)) for i, q in enumerate(connections)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    results.sort(key=lambda x: (x['feed'], x['date']))
+    for result in results:
+        if result['status'] != OK:
+            logging.error(f"{result['feed']} {result['date']} is {result['status']}: {'; '.join(result['problems'])}")
+    logging.info(f"Validated {len(results)} partitions, {sum(x['status'] == OK for x in results)} ok")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the HDB partitions against the row counts and checksums recorded while loading.')
+    parser.add_argument('--workers', type=int, default=N_WORKERS, help='number of Q processes validating in parallel')
+    parser.add_argument('--ports', type=int, nargs='*', help='ports of running Q processes (default: consecutive ports from --base-port)')
+    parser.add_argument('--base-port', type=int, default=Q_PORT_NUMBER)
+    parser.add_argument('--feeds', nargs='*', default=list(FEEDS), choices=list(FEEDS))
+    parser.add_argument('--manifest', default=MANIFEST_FILE)
+    parser.add_argument('--kdb-root', default=KDB_ROOT_DIR, help='directory holding the HDBs, one sub directory per feed')
+    parser.add_argument('--start', type=iso_date, help='first date to check, YYYY-MM-DD like the loaders')
+    parser.add_argument('--end', type=iso_date, help='last date to check, YYYY-MM-DD')
+    parser.add_argument('--report', help='write the result of every partition as json lines to this file')
+    parser.add_argument('--log-dir', default=LOG_DIR)
+    args = parser.parse_args()
+    # the manifest knows the dates as the partitions are named, YYYY.MM.DD
+    start_date = None if args.start is None else args.start.replace('-', '.')
+    end_date = None if args.end is None else args.end.replace('-', '.')
+    
+    setup_logging('validate_hdb', args.log_dir)
+    logging.info('Started')
+    
+    ports = args.ports if args.ports else [args.base_port + i for i in range(args.workers)]
+    manifest = IngestManifest(args.manifest)
+    connections = []
+    try:
+        for port_num in ports:
+            connections.append(ManagedQConnection(host='localhost', port=port_num))
+            connections[-1].open()
+        results = validate_feeds(connections, args.feeds, manifest, start_date, end_date, kdb_root=args.kdb_root)
+    finally:
+        for q in connections:
+            q.close()
+        manifest.close()
+    if args.report is not None:
+        with open(args.report, 'w') as f_out:
+            for result in results:
+                f_out.write(json.dumps(result) + '\n')
+    
+    logging.info('Finished')
+    sys.exit(0 if all(x['status'] == OK for x in results) else 1)
+
+
+if __name__ == '__main__':
+    main()